@@ -0,0 +1,48 @@
+"""add player_stats table
+
+Revision ID: 3afd2ca808f2
+Revises: 875510aef793
+Create Date: 2026-10-18 10:12:41.503127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3afd2ca808f2'
+down_revision = '875510aef793'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('player_stats',
+    sa.Column('player_id', sa.BigInteger(), nullable=False),
+    sa.Column('wins', sa.Integer(), nullable=False),
+    sa.Column('losses', sa.Integer(), nullable=False),
+    sa.Column('complete', sa.Integer(), nullable=False),
+    sa.Column('confirmed', sa.Integer(), nullable=False),
+    sa.Column('last_played_ts', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['player_id'], ['player.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('player_id')
+    )
+
+    # Backfill from the existing games; this matches PlayerStats.refresh
+    op.execute("""
+        INSERT INTO player_stats (player_id, wins, losses, complete, confirmed, last_played_ts)
+        SELECT
+            player.id,
+            count(game.id) FILTER (WHERE game.winner_id = player.id),
+            count(game.id) FILTER (WHERE game.winner_id != player.id),
+            count(game.id) FILTER (WHERE game.is_complete),
+            count(game.id) FILTER (WHERE game.is_complete AND game.is_confirmed),
+            max(game.win_claimed_ts) FILTER (WHERE game.is_complete AND game.is_confirmed)
+        FROM player
+        LEFT JOIN game ON game.host_id = player.id OR game.away_id = player.id
+        GROUP BY player.id
+    """)
+
+
+def downgrade():
+    op.drop_table('player_stats')
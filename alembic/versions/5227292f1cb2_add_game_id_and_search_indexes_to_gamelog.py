@@ -0,0 +1,42 @@
+"""add game_id and search indexes to gamelog
+
+Revision ID: 5227292f1cb2
+Revises: e0cc4de27385
+Create Date: 2026-10-18 12:20:54.117092
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5227292f1cb2'
+down_revision = 'e0cc4de27385'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    op.add_column('gamelog', sa.Column('game_id', sa.Integer(), nullable=True))
+    # Entries are prefixed with __GAMEID__, and 0 was used for entries not about a game
+    op.execute("""
+        UPDATE gamelog
+        SET game_id = NULLIF(substring(message FROM '^__([0-9]+)__')::integer, 0)
+        WHERE message ~ '^__[0-9]+__'
+    """)
+
+    op.create_index('ix_gamelog_game_id', 'gamelog', ['game_id'])
+    op.create_index('ix_gamelog_message_ts_id', 'gamelog', ['message_ts', 'id'])
+    op.create_index(
+        'ix_gamelog_message_trgm', 'gamelog', ['message'],
+        postgresql_using='gin', postgresql_ops={'message': 'gin_trgm_ops'}
+    )
+
+
+def downgrade():
+    op.drop_index('ix_gamelog_message_trgm', table_name='gamelog')
+    op.drop_index('ix_gamelog_message_ts_id', table_name='gamelog')
+    op.drop_index('ix_gamelog_game_id', table_name='gamelog')
+    op.drop_column('gamelog', 'game_id')
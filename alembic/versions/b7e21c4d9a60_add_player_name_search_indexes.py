@@ -0,0 +1,43 @@
+"""add player name search indexes
+
+Revision ID: b7e21c4d9a60
+Revises: 5227292f1cb2
+Create Date: 2026-10-18 13:41:08.652419
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e21c4d9a60'
+down_revision = '5227292f1cb2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    op.add_column('player', sa.Column('ign_folded', sa.String(), sa.Computed('lower(ign)'), nullable=True))
+    op.add_column(
+        'player', sa.Column('steam_name_folded', sa.String(), sa.Computed('lower(steam_name)'), nullable=True)
+    )
+    op.create_index('ix_player_ign_folded', 'player', ['ign_folded'])
+    op.create_index('ix_player_steam_name_folded', 'player', ['steam_name_folded'])
+
+    for column in ('name', 'ign', 'steam_name'):
+        op.create_index(
+            f'ix_player_{column}_trgm', 'player', [column],
+            postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'}
+        )
+
+
+def downgrade():
+    for column in ('steam_name', 'ign', 'name'):
+        op.drop_index(f'ix_player_{column}_trgm', table_name='player')
+
+    op.drop_index('ix_player_steam_name_folded', table_name='player')
+    op.drop_index('ix_player_ign_folded', table_name='player')
+    op.drop_column('player', 'steam_name_folded')
+    op.drop_column('player', 'ign_folded')
@@ -0,0 +1,38 @@
+"""add game indexes
+
+Revision ID: e0cc4de27385
+Revises: 3afd2ca808f2
+Create Date: 2026-10-18 11:02:17.840316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e0cc4de27385'
+down_revision = '3afd2ca808f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_game_host_id_win_claimed_ts', 'game', ['host_id', 'win_claimed_ts'])
+    op.create_index('ix_game_away_id_win_claimed_ts', 'game', ['away_id', 'win_claimed_ts'])
+    op.create_index('ix_game_winner_id_win_claimed_ts', 'game', ['winner_id', 'win_claimed_ts'])
+    op.create_index(
+        'ix_game_unconfirmed', 'game', ['win_claimed_ts'],
+        postgresql_where=sa.text('is_complete IS true AND is_confirmed IS false')
+    )
+    op.create_index(
+        'ix_game_unstarted', 'game', ['host_switched', 'opened_ts'],
+        postgresql_where=sa.text('is_started IS false')
+    )
+
+
+def downgrade():
+    op.drop_index('ix_game_unstarted', table_name='game')
+    op.drop_index('ix_game_unconfirmed', table_name='game')
+    op.drop_index('ix_game_winner_id_win_claimed_ts', table_name='game')
+    op.drop_index('ix_game_away_id_win_claimed_ts', table_name='game')
+    op.drop_index('ix_game_host_id_win_claimed_ts', table_name='game')
@@ -5,8 +5,10 @@ import os
 import re
 from discord.ext import commands
 
-from ladderbot import db, settings
+from ladderbot import db, search, settings
 from ladderbot.logging import logger
+from ladderbot.outbox import outbox
+from ladderbot.scheduler import deadlines
 
 
 class Admin(commands.Cog):
@@ -15,40 +17,74 @@ class Admin(commands.Cog):
         self.bot = bot
         self.conf = conf
     
+    async def reload_signups(self):
+        """Reload the League cog's signup registry after changing players or signups behind its back."""
+        if league := self.bot.get_cog('League'):
+            await league.load_signups()
+    
     @commands.Cog.listener()
     async def on_ready(self):
         s = f'Online. Logged in as {self.bot.user.name}/{self.bot.user.id}, PID {os.getpid()}'
         print(s)
         logger.info(s)
+        if guild := self.bot.get_guild(settings.server_id):
+            settings.role_registry.refresh(guild)
+            search.members.build(guild)
+    
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role: discord.Role):
+        if role.guild.id == settings.server_id:
+            settings.role_registry.refresh(role.guild)
+    
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        if after.guild.id == settings.server_id:
+            settings.role_registry.refresh(after.guild)
+    
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        if role.guild.id == settings.server_id:
+            settings.role_registry.refresh(role.guild)
     
     @commands.command(aliases=['restart'])
     @commands.is_owner()
     async def quit(self, ctx: commands.Context):
         """Stop the bot's process."""
-        db.session.close()
+        await db.run(db.engine.dispose)
         logger.info('Shutting down.')
         await ctx.send('Shutting down...')
         await self.bot.close()
     
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def dm_outbox(self, ctx: commands.Context):
+        """*Owner*: show how the DM outbox is doing."""
+        metrics = ', '.join(f'{key}: {value}' for key, value in sorted(outbox.metrics.items())) or 'nothing sent yet'
+        await ctx.send(f'{len(outbox)} DMs queued. {metrics}')
+    
     @commands.command(hidden=True)
     @commands.is_owner()
     async def confirm_clear_signupmessages(self, ctx):
-        db.SignupMessage.query().delete()
-        db.save()
+        await db.run(db.SignupMessage.query().delete)
+        await db.run(db.save)
+        if league := self.bot.get_cog('League'):
+            league.message_id, league.signup_id = None, None
         await ctx.send('Cleared.')
 
     @commands.command(hidden=True)
     @commands.is_owner()
     async def confirm_clear_players(self, ctx):
-        db.Player.query().delete()
-        db.save()
+        await db.run(db.Player.query().delete)
+        await db.run(db.save)
+        await self.reload_signups()
         await ctx.send('Cleared.')
 
     @commands.command(hidden=True)
     @commands.is_owner()
     async def confirm_clear_signups(self, ctx):
-        db.Signup.query().delete()
-        db.save()
+        await db.run(db.Signup.query().delete)
+        await db.run(db.save)
+        await self.reload_signups()
         await ctx.send('Cleared.')
     
     @commands.command()
@@ -64,9 +100,14 @@ class Admin(commands.Cog):
         if game.is_complete and '-override' not in args.lower():
             return await ctx.send(f'Please unwin the game first.')
         
-        db.GameLog.write(game_id=game.id, message=f'{db.GameLog.member_string(ctx.author)} manually deleted the game.')
+        await db.run(
+            db.GameLog.write,
+            game_id=game.id, message=f'{db.GameLog.member_string(ctx.author)} manually deleted the game.'
+        )
         
-        db.delete(game)
+        await db.run(game.delete)
+        db.leaderboard_index.invalidate()
+        deadlines.cancel(game.id)
         
         logger.info(f'Game {game.id} deleted.')
         
@@ -86,46 +127,51 @@ class Admin(commands.Cog):
     
         if not game:
             
-            games = db.Game.query().filter(
-                db.Game.is_complete.is_(True),
-                db.Game.is_confirmed.is_(False)
-            )
+            games = db.Game.unconfirmed().order_by(db.Game.win_claimed_ts.asc(), db.Game.id.asc())
             
-            fields = []
-
-            for game in games:
-
-                content_str = f'**WINNER**: (Unconfirmed) {game.winner.member(ctx.guild).display_name}'
+            def list_games(offset, limit):
+                fields = []
     
-                fields.append(
-                    (
-                        f'Game {game.id}   {game.host.name} vs {game.away.name}\n*{game.name}*',
-                        f'{(game.started_ts or game.opened_ts).date().isoformat()} - {content_str}'
+                for g in games.offset(offset).limit(limit):
+    
+                    content_str = f'**WINNER**: (Unconfirmed) {g.winner.member(ctx.guild).display_name}'
+        
+                    fields.append(
+                        (
+                            f'Game {g.id}   {g.host.name} vs {g.away.name}\n*{g.name}*',
+                            f'{(g.started_ts or g.opened_ts).date().isoformat()} - {content_str}'
+                        )
                     )
-                )
+                return fields
+            
+            async def fetch(offset, limit):
+                return await db.run(list_games, offset, limit)
+            
+            count = await db.run(games.count)
             
             return await settings.paginate(
-                ctx, fields=fields, title=f'{games.count()} unconfirmed games',
-                page_start=0, page_end=15, page_size=15
+                ctx, fields=settings.Paginator(fetch, page_size=15, count=count), title=f'{count} unconfirmed games'
             )
         
         if not (game.is_complete and not game.is_confirmed):
             return await ctx.send(f'`{ctx.prefix}confirm` can only be used on complete but unconfirmed games.')
 
-        db.GameLog.write(
+        winner: db.Player = await db.run(lambda: game.winner)
+        await db.run(
+            db.GameLog.write,
             game_id=game.id,
-            message=f'Win confirmed for winner **{discord.utils.escape_markdown(game.winner.name)}** '
+            message=f'Win confirmed for winner **{discord.utils.escape_markdown(winner.name)}** '
                     f'by Mod {db.GameLog.member_string(ctx.author)} '
         )
-        game.win_confirmed(game.winner_id)
-        await game.process_win()
+        await db.run(game.win_confirmed, game.winner_id)
+        deadlines.sync(game)
         self.bot.loop.create_task(
             settings.fix_roles(
-                ctx.author, game.host.member(ctx.guild), game.away.member(ctx.guild)
+                ctx.author, ctx.guild.get_member(game.host_id), ctx.guild.get_member(game.away_id)
             )
         )
         await self.bot.get_cog('Matchmaking').announce_end(ctx.guild, ctx.channel, game)
-        await ctx.send(f'Game **{game.id}** winner confirmed as **{discord.utils.escape_markdown(game.winner.name)}**')
+        await ctx.send(f'Game **{game.id}** winner confirmed as **{discord.utils.escape_markdown(winner.name)}**')
     
     @commands.command()
     @settings.is_mod_check()
@@ -134,46 +180,58 @@ class Admin(commands.Cog):
         *Mod*: Search game logs
         """
         
-        if search_term is None:
-            search_term = ''
-    
-        search_term = re.sub(r'\b(\d{1,6})\b', r'\_\1\_', search_term, count=1) if search_term else None
-        # Above finds a 2-6 digit number in search_term and adds underscores around it
-        # This will cause it to match against the __GAMEID__ the log entries are prefixed with and not substrings from
-        # user IDs
+        search_term = search_term or ''
 
         # replace @Mentions <@272510639124250625> with just the ID 272510639124250625
-        search_term = re.sub(r'<@[!&]?([0-9]{17,21})>', '\\1', search_term) if search_term else None
+        search_term = re.sub(r'<@[!&]?([0-9]{17,21})>', '\\1', search_term)
+
+        # A standalone number of up to 6 digits is a game ID rather than part of a user ID
+        game_id = None
+        if match := re.search(r'\b(\d{1,6})\b', search_term):
+            game_id = int(match.group(1))
+            search_term = ' '.join((search_term[:match.start()] + search_term[match.end():]).split())
+
+        page_size = 50
+
+        async def entries():
+            before = None
+            while True:
+                page = await db.run(
+                    db.GameLog.search(search_term, game_id=game_id, before=before, limit=page_size).all
+                )
+                if not page and before is None:
+                    yield 'ERROR', 'No entries found'
+                for entry in page:
+                    yield f'`{entry.message_ts.strftime("%Y-%m-%d %H:%M:%S")}`', entry.message[:500]
+                if len(page) < page_size:
+                    return
+                before = page[-1].message_ts, page[-1].id
+
+        title = f'Searching for log entries containing *{search_term}*'
+        if game_id is not None:
+            title += f' in game {game_id}'
+
+        await settings.paginate(ctx, title, entries())
 
-        results = db.GameLog.search(search_term)
-        
-        message_list = []
-        for entry in results:
-            message_list.append(
-                (f'`{entry.message_ts.strftime("%Y-%m-%d %H:%M:%S")}`', entry.message[:500])
-            )
-            
-        message_list = message_list or [('ERROR', 'No entries found')]
-        
-        await settings.paginate(
-            ctx, f'Searching for log entries containing *{search_term}*'.replace("_", ""),
-            message_list
-        )
-    
     @commands.Cog.listener()
     async def on_member_remove(self, member):
+        if member.guild.id == settings.server_id:
+            search.members.remove(member.id)
         
-        player: db.Player = db.Player.get(member.id)
+        player: db.Player = await db.run(db.Player.get, member.id)
         
         if not player:
             return
         
-        if signups := db.Signup.query().filter(db.Signup.player == player):
-            signups.delete()
+        if signups := db.Signup.query().filter(db.Signup.player_id == player.id):
+            await db.run(signups.delete)
         
         player.active = False
-        mod_role = discord.utils.get(member.guild.roles, name='Mod')
-        if (incomplete_games_count := player.incomplete().count()) != 0:
+        await db.run(db.save)
+        db.leaderboard_index.invalidate()
+        await self.reload_signups()
+        mod_role = settings.role_registry.of(member.guild)['Mod']
+        if (incomplete_games_count := await db.run(player.incomplete().count)) != 0:
             await settings.discord_channel_log(
                 f'{mod_role.mention} - {member.mention} ({member.display_name}) has left the server and has '
                 f'{incomplete_games_count} incomplete games.'
@@ -181,24 +239,38 @@ class Admin(commands.Cog):
         
     @commands.Cog.listener()
     async def on_member_join(self, member):
+        if member.guild.id == settings.server_id:
+            search.members.add_member(member)
         
-        player: db.Player = db.Player.get(member.id)
+        player: db.Player = await db.run(db.Player.get, member.id)
         
         if not player:
             return
         
         player.active = True
         player.name = member.name
+        await db.run(player.save)
+        db.leaderboard_index.invalidate()
+        
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if after.guild.id == settings.server_id and (before.nick, before.name) != (after.nick, after.name):
+            search.members.add_member(after)
         
     @commands.Cog.listener()
     async def on_user_update(self, before: discord.User, after: discord.User):
         if before.name != after.name:
-            p: db.Player = db.Player.get(after.id)
+            if member := self.bot.get_guild(settings.server_id).get_member(after.id):
+                search.members.add_member(member)
+            p: db.Player = await db.run(db.Player.get, after.id)
+            if p is None:
+                return
             p.name = after.name
     
-            p.save()
+            await db.run(p.save)
     
-            db.GameLog.write(
+            await db.run(
+                db.GameLog.write,
                 message=f'{db.GameLog.member_string(after)} changed username from `{before.name}` to `{after.name}`.'
             )
         
@@ -211,20 +283,18 @@ class Admin(commands.Cog):
         if not game:
             return await ctx.send('Game ID not provided.')
         
-        old_host, host_step, old_away, away_step = game.host, game.host_step, game.away, game.away_step
-        game.host = old_away
-        game.host_step = away_step
-        game.away = old_host
-        game.away_step = host_step
-        game.host_switched = True
-    
-        game.save()
+        def swap_host():
+            with db.unit_of_work():
+                old_host, old_away = game.swap_host()
+                db.GameLog.write(
+                    message=f'Host switched from `{old_host.name}` to `{old_away.name}` by '
+                            f'{db.GameLog.member_string(ctx.author)}.',
+                    game_id=game.id
+                )
+            return old_host, old_away
         
-        db.GameLog.write(
-            message=f'Host switched from `{old_host.name}` to `{old_away.name}` by '
-                    f'{db.GameLog.member_string(ctx.author)}.',
-            game_id=game.id
-        )
+        old_host, old_away = await db.run(swap_host)
+        deadlines.sync(game)
         
         return await ctx.send(f'Host changed from **{old_host.name}** to **{old_away.name}**.')
     
@@ -237,13 +307,16 @@ class Admin(commands.Cog):
         
         done = 0
         
-        for player in (db.Player.query() if not member else db.Player.query().filter_by(id=member.id)):
+        players = db.Player.query() if not member else db.Player.query().filter_by(id=member.id)
+        for player in await db.run(players.all):
             player: db.Player
             
-            games = db.Game.query().filter(
-                db.or_(db.Game.host_id == player.id, db.Game.away_id == player.id) &
-                db.Game.is_confirmed.is_(True)
-            ).order_by(db.Game.win_claimed_ts.asc())
+            games = await db.run(
+                db.Game.query().filter(
+                    db.or_(db.Game.host_id == player.id, db.Game.away_id == player.id) &
+                    db.Game.is_confirmed.is_(True)
+                ).order_by(db.Game.win_claimed_ts.asc()).all
+            )
             
             player_rung = 1
             
@@ -271,14 +344,16 @@ class Admin(commands.Cog):
                 await ctx.send(f'Player {player.name} ({player.id}) had rung {player.rung} in the database, '
                                f'but should have had {player_rung}. Fixing...')
             
-                db.GameLog.write(
+                await db.run(
+                    db.GameLog.write,
                     f'{db.GameLog.member_string(player)} - rung changed to {player_rung} from {player.rung} as part of '
                     f'a rung check.'
                 )
                 
                 player.rung = player_rung
                 
-                player.save()
+                await db.run(player.save)
+                db.leaderboard_index.invalidate()
                 
                 if (m := ctx.guild.get_member(player.id)) and is_bad:
                     self.bot.loop.create_task(settings.fix_roles(m))
@@ -290,26 +365,23 @@ class Admin(commands.Cog):
     @commands.command()
     @settings.is_mod_check()
     async def deactivate(self, ctx: commands.Context):
+        roles = settings.role_registry.of(ctx.guild)
         
-        for player in db.Player.query().all():
+        for player in await db.run(db.Player.query().all):
             player: db.Player
             if player.active and getattr(
-                    player.incomplete().first(), 'opened_ts',
+                    await db.run(player.incomplete().first), 'opened_ts',
                     datetime.datetime.utcnow()
             ) < (datetime.datetime.utcnow() - datetime.timedelta(weeks=2)):
                 member: discord.Member = player.member(ctx.guild)
                 if member is None:
                     continue
                 
-                if discord.utils.get(player.member(ctx.guild).roles, name='Mod'):
+                if roles['Mod'] in member.roles:
                     continue
                     
-                await member.remove_roles(
-                    discord.utils.get(ctx.guild.roles, name='Champion')
-                )
-                await member.add_roles(
-                    discord.utils.get(ctx.guild.roles, name='Inactive')
-                )
+                await member.remove_roles(roles['Champion'])
+                await member.add_roles(roles['Inactive'])
                 
                 await ctx.send(f'Applied inactive role to {player}/{member}')
         await ctx.send('Completed deactivate.')
@@ -318,34 +390,45 @@ class Admin(commands.Cog):
     @commands.is_owner()
     async def migrate(self, ctx: commands.Context, src: discord.Member, dest: discord.Member):
 
-        srcp = db.Player.get(src.id)
+        srcp = await db.run(db.Player.get, src.id)
 
         if srcp is None:
             return await ctx.send(f'{src.mention} isn\'t registered with the bot and therefore cannot be migrated.')
 
-        for game in db.Game.query().filter(db.or_(db.Game.host_id == src.id, db.Game.away_id == src.id)).all():
-            for attr in ('host_id', 'away_id', 'winner_id', 'win_claimed_by'):
-                if getattr(game, attr) == src.id:
-                    setattr(game, attr, dest.id)
-
-        db.save()
-
-        for signup in db.Signup.query().all():
-            if signup.player_id == srcp.id:
-                signup.player_id = dest.id
+        def migrate_games():
+            for game in db.Game.query().filter(db.or_(db.Game.host_id == src.id, db.Game.away_id == src.id)).all():
+                for attr in ('host_id', 'away_id', 'winner_id', 'win_claimed_by'):
+                    if getattr(game, attr) == src.id:
+                        setattr(game, attr, dest.id)
+                # The ids were changed directly, so reload the player relationships on next access
+                db.session.expire(game, ['host', 'away', 'winner'])
+    
+            db.save()
+    
+            for signup in db.Signup.query().all():
+                if signup.player_id == srcp.id:
+                    signup.player_id = dest.id
+    
+            db.PlayerStats.refresh(dest.id)
+            db.save()
+            srcp.id = dest.id
+            srcp.delete()
 
-        db.save()
-        srcp.id = dest.id
-        srcp.delete()
+        await db.run(migrate_games)
+        db.leaderboard_index.invalidate()
+        db.opponent_history.invalidate()
+        await self.reload_signups()
 
-        db.GameLog.write(f'{src.id} migrated to {dest.id}')
+        await db.run(db.GameLog.write, f'{src.id} migrated to {dest.id}')
         await ctx.send(f'{src.id} migrated to {dest.id}')
 
     @commands.command()
     @commands.is_owner()
     async def delete_player(self, ctx: commands.Context, m: discord.Member):
-        if player := db.Player.get(m.id):
-            player.delete()
+        if player := await db.run(db.Player.get, m.id):
+            await db.run(player.delete)
+            db.leaderboard_index.invalidate()
+            await self.reload_signups()
 
         return await ctx.send(f'Player {m.mention} deleted.')
 
@@ -0,0 +1,97 @@
+# Copyright (c) 2021 Jasper Harrison. This file is licensed under the terms of the Apache license, version 2.0. #
+import asyncio
+import datetime
+import typing
+
+from . import db, settings
+from .logging import logger
+
+Handler = typing.Callable[[db.Job], typing.Awaitable[typing.Any]]
+
+
+class JobQueue:
+    """
+    Runs the jobs in the job table, one at a time, at their scheduled time.
+
+    `run_next` looks up the next pending job once, then sleeps until it's due or until `add` schedules something new,
+    so nothing queries the table in between. Each job is claimed with a lease before its handler runs and marked done
+    once it returns; failed jobs are retried with a growing delay, up to `retries` attempts.
+    """
+
+    def __init__(
+            self, lease: datetime.timedelta = datetime.timedelta(minutes=30), retries: int = 3,
+            backoff: datetime.timedelta = datetime.timedelta(minutes=5)
+    ):
+        self.lease = lease
+        self.retries = retries
+        self.backoff = backoff
+        self.handlers: typing.Dict[str, Handler] = {}
+        self._changed: typing.Optional[asyncio.Event] = None
+
+    def handler(self, kind: str, func: Handler):
+        """Run `func(job)` for jobs of `kind`."""
+        self.handlers[kind] = func
+
+    def wake(self):
+        """Look for the next job again. Call after scheduling a job without `add`."""
+        if self._changed is not None:
+            self._changed.set()
+
+    async def add(self, kind: str, run_at: datetime.datetime, key: str, **payload) -> bool:
+        """Schedule a job unless one with `key` exists already. Returns whether it was added."""
+        added = await db.run(db.Job.schedule, kind, run_at, key, payload or None)
+        self.wake()
+        return added
+
+    async def run_next(self):
+        """Wait for the next job to be due and run it, or return early if a job was added in the meantime."""
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        # Cleared before looking, so a job added while we look still wakes us
+        self._changed.clear()
+
+        # Each lookup and each job gets its own session, so the loop doesn't hold a connection while it sleeps
+        async with db.scope():
+            job = await db.run(db.Job.next_pending)
+        now = datetime.datetime.utcnow()
+        if job is None or job.due_at > now:
+            timeout = (job.due_at - now).total_seconds() if job is not None else None
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return
+
+        async with db.scope():
+            await self._run(job.id, now)
+
+    async def _run(self, job_id: int, now: datetime.datetime):
+        job = await db.run(db.Job.claim, job_id, now + self.lease)
+        if job is None:
+            return
+
+        kind, key, attempts = job.kind, job.key, job.attempts
+        logger.info(f'Running {kind} job {key} (attempt {attempts})')
+        try:
+            handler = self.handlers.get(kind)
+            if handler is None:
+                raise LookupError(f'No handler for {kind} jobs')
+            await handler(job)
+        except Exception as e:
+            logger.exception(f'{kind} job {key} failed: {e}')
+            # Expire the job, so retry/fail see whether the handler finished it before failing
+            await db.run(db.session.rollback)
+            if attempts >= self.retries:
+                await db.run(job.fail, repr(e))
+                await settings.discord_channel_log(
+                    f'Job {key} failed after {attempts} attempts (notifying <@{settings.owner_id}>): {e}'
+                )
+            else:
+                await db.run(job.retry, repr(e), datetime.datetime.utcnow() + self.backoff * attempts)
+                await settings.discord_channel_log(f'Job {key} failed, retrying: {e}')
+        else:
+            await db.run(job.finish)
+
+
+# Handlers are registered, and `run_next` driven, by the League cog
+jobs = JobQueue()
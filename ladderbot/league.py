@@ -1,16 +1,36 @@
 # Copyright (c) 2021 Jasper Harrison. This file is licensed under the terms of the Apache license, version 2.0. #
 import datetime
-import discord
+import itertools
 import random
-from typing import Dict, List
+import time
+from typing import Dict, List, Tuple
 
-from discord import TextChannel, Member, Message, RawReactionActionEvent, AllowedMentions, Embed, User
+from discord import TextChannel, Member, PartialMessage, RawReactionActionEvent, AllowedMentions, Embed
 from discord.ext import commands, tasks
 from jinja2 import Template
+from sqlalchemy import or_
 
-from ladderbot import settings, db
+from ladderbot import settings, db, pairing
+from ladderbot.jobs import jobs
+from ladderbot.outbox import outbox
+from ladderbot.scheduler import deadlines
 from ladderbot.logging import logger
 
+# Compiled once; `League.announcement` streams it a tier at a time
+MATCHUPS_TEMPLATE = Template(
+    """
+**{{platform}}**:\n
+{% for tier, games in gms.items() if games is not none %}
+Tier {{tier}} matchups:
+{% for game in games %}
+<@{{game.host_id}}> ({{game.host_step}}) hosts vs <@{{game.away_id}}> ({{game.away_step}}) - Game {{game.id}}
+{% endfor %}
+
+
+{% endfor %}
+"""
+)
+
 
 class League(commands.Cog):
     
@@ -18,54 +38,71 @@ class League(commands.Cog):
         self.bot = bot
         self.conf = conf
         
+        # The open SignupMessage's discord message id and primary key, or None when signups are closed. Loaded in
+        # `pre_loop` and kept up to date by open_signups/close_signups, so reactions can be filtered without a query.
         self.message_id = None
+        self.signup_id = None
+        # Which platforms each registered player has a name for, as (mobile, steam), and which platform each signed up
+        # player is signed up for. Loaded in one query by `load_signups`, so signups don't read the database.
+        self.registered: Dict[int, Tuple[bool, bool]] = {}
+        self.signed_up: Dict[int, bool] = {}
         
         self.relevant_emojis = [
             settings.emojis.blue_check_mark,
             settings.emojis.white_check_mark
         ]
         
-        self.signup_loop.start()
+        self.pairing: pairing.PairingEngine = pairing.RungDistancePairing(
+            is_rematch=db.opponent_history.is_rematch
+        )
+        
+        jobs.handler('open_signups', self.open_signups_job)
+        jobs.handler('close_signups', self.close_signups_job)
+        jobs.handler('create_matchups', self.create_matchups_job)
+        self.job_loop.start()
     
     def cog_unload(self):
-        self.signup_loop.cancel()
+        self.job_loop.cancel()
+    
+    async def load_signups(self):
+        def load():
+            players = db.session.query(db.Player.id, db.Player.ign, db.Player.steam_name).all()
+            signups = db.session.query(db.Signup.player_id, db.Signup.mobile).filter(
+                db.Signup.player_id.isnot(None)
+            ).all()
+            return players, signups
+        
+        players, signups = await db.run(load)
+        self.registered = {player_id: (ign is not None, steam is not None) for player_id, ign, steam in players}
+        self.signed_up = dict(signups)
+    
+    def update_player(self, player: db.Player):
+        """Record a change to a player's names, so signups see it."""
+        self.registered[player.id] = (player.ign is not None, player.steam_name is not None)
     
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload: RawReactionActionEvent):
-        signupmessage: db.SignupMessage = db.SignupMessage.query().filter(
-            db.SignupMessage.is_open.is_(True)
-        ).first()
-        
-        if self.message_id != getattr(signupmessage, 'message_id', self.message_id):
-            self.message_id = signupmessage.message_id
-        
         if payload.message_id != self.message_id:
             return
         
         if payload.user_id == self.bot.user.id:
             return
 
+        # Reactions are removed through a partial message, so nothing has to be fetched
         channel = payload.member.guild.get_channel(payload.channel_id)
-        message: Message = await channel.fetch_message(payload.message_id)
-        emoji = self.bot.get_emoji(payload.emoji.id) if payload.emoji.id else payload.emoji
+        message: PartialMessage = channel.get_partial_message(payload.message_id)
+        emoji = payload.emoji
 
         if emoji.name not in self.relevant_emojis:
             await message.remove_reaction(emoji, payload.member)
         
         if emoji.name == settings.emojis.white_check_mark:
-            await self.add_signup(payload.member, signupmessage, message, emoji, mobile=True)
+            await self.add_signup(payload.member, self.signup_id, message, emoji, mobile=True)
         elif emoji.name == settings.emojis.blue_check_mark:
-            await self.add_signup(payload.member, signupmessage, message, emoji, mobile=False)
+            await self.add_signup(payload.member, self.signup_id, message, emoji, mobile=False)
     
     @commands.Cog.listener()
     async def on_raw_reaction_remove(self, payload: RawReactionActionEvent):
-        msg: db.SignupMessage = db.SignupMessage.query().filter(
-            db.SignupMessage.is_open.is_(True)
-        ).first()
-        
-        if self.message_id != getattr(msg, 'message_id', self.message_id):
-            self.message_id = msg.message_id
-        
         if payload.message_id != self.message_id:
             return
         
@@ -78,93 +115,144 @@ class League(commands.Cog):
         member = self.bot.get_user(payload.user_id)
         
         if payload.emoji.name == settings.emojis.white_check_mark:
-            await self.remove_signup(member, msg, mobile=True)
+            await self.remove_signup(member, self.signup_id, mobile=True)
         elif payload.emoji.name == settings.emojis.blue_check_mark:
-            await self.remove_signup(member, msg, mobile=False)
+            await self.remove_signup(member, self.signup_id, mobile=False)
     
-    @staticmethod
-    async def add_signup(member: Member, signupmessage, message: Message, emoji, mobile):
+    async def add_signup(self, member: Member, signup_id: int, message: PartialMessage, emoji, mobile):
+        
+        if member.id not in self.registered:
+            # Registered since the registry was loaded
+            if p := await db.run(db.Player.get, member.id):
+                self.update_player(p)
         
-        p: db.Player = db.Player.get(member.id)
-        if not p:
+        has_mobile, has_steam = self.registered.get(member.id, (None, None))
+        if has_mobile is None:
             await message.remove_reaction(emoji, member)
-            return await member.send(f'You must be registered with me to signup for matches.')
-        elif p.ign is None and mobile:
+            return outbox.send(member, f'You must be registered with me to signup for matches.')
+        elif not has_mobile and mobile:
             await message.remove_reaction(emoji, member)
-            return await member.send(f'You have not set your mobile name.')
-        elif p.steam_name is None and not mobile:
+            return outbox.send(member, f'You have not set your mobile name.')
+        elif not has_steam and not mobile:
             await message.remove_reaction(emoji, member)
-            return await member.send(f'You have not set your steam name.')
+            return outbox.send(member, f'You have not set your steam name.')
         
-        if (s := db.Signup.query().filter(db.Signup.player_id == member.id).first()) is not None:
+        if (signed_up_mobile := self.signed_up.get(member.id)) is not None:
             await message.remove_reaction(emoji, member)
-            platform_str = 'mobile' if s.mobile else 'steam'
-            return await member.send(
+            platform_str = 'mobile' if signed_up_mobile else 'steam'
+            return outbox.send(
+                member,
                 f'You are already signed up for {platform_str}. You cannot signup for both platforms.'
             )
         
         signup = db.Signup(
-            signup_id=signupmessage.id,
+            signup_id=signup_id,
             player_id=member.id,
             mobile=mobile
         )
         
-        signup.save()
+        self.signed_up[member.id] = mobile
+        try:
+            await db.run(signup.save)
+        except Exception:
+            del self.signed_up[member.id]
+            raise
         
-        await member.send(
+        outbox.send(
+            member,
             f'You are now signed up for next week\'s **{"mobile" if mobile else "steam"}** games. '
             f'If you would like to remove yourself, just remove the reaction you just placed.'
         )
         logger.debug(
             f'{member.name} signed up for {"steam" if not mobile else "mobile"} matchups, signupmessage id '
-            f'{signupmessage.id}'
+            f'{signup_id}'
         )
     
-    @staticmethod
-    async def remove_signup(member: Member, signupmessage, mobile):
-        signup: db.Signup = db.Signup.query().filter_by(
-            signup_id=signupmessage.id,
-            player_id=member.id,
-            mobile=mobile
-        ).first()
+    async def remove_signup(self, member: Member, signup_id: int, mobile):
+        if self.signed_up.get(member.id) != mobile:
+            # Rejected reactions are removed by the bot, which lands here too
+            return
         
-        if signup:
-            signup.delete()
-            
-            await member.send(
+        deleted = await db.run(
+            db.Signup.query().filter_by(
+                signup_id=signup_id,
+                player_id=member.id,
+                mobile=mobile
+            ).delete
+        )
+        await db.run(db.save)
+        
+        if deleted:
+            # A reaction removed from an older signup message leaves the current signup in place
+            del self.signed_up[member.id]
+            outbox.send(
+                member,
                 f'You have been removed from the list of players for next week\'s **{"mobile" if mobile else "steam"}**'
                 f' games. You can sign back up by reacting to the signup message again.'
             )
             logger.debug(
                 f'{member.name} removed from signups for the {"steam" if not mobile else "mobile"} '
-                f'matchups of signup id {signupmessage.id}'
+                f'matchups of signup id {signup_id}'
             )
     
-    @tasks.loop(minutes=5)
-    async def signup_loop(self):
-        signupmessage = db.SignupMessage.query().filter_by(is_open=True).first()
-        if signupmessage:
-            # Signups are open. Check if we can close them.
-            if signupmessage.close_at < datetime.datetime.utcnow():
-                logger.info('Closing signups.')
-                await self.close_signups()
-        else:
-            if datetime.datetime.utcnow().weekday() == 5:
-                signupmessages = db.SignupMessage.query().filter(
-                    db.SignupMessage.close_at > datetime.datetime.utcnow()
-                ).count()
-                if not signupmessages:
-                    # It's saturday, open the signups
-                    logger.info('Opening signups')
-                    await self.open_signups()
-                else:
-                    logger.info(
-                        'Not opening signups, as there is a signupmessage object with a closing date later than now.'
-                    )
+    @tasks.loop(seconds=0)
+    async def job_loop(self):
+        await jobs.run_next()
     
-    @signup_loop.before_loop
+    @job_loop.before_loop
     async def pre_loop(self):
         await self.bot.wait_until_ready()
+        
+        async with db.scope():
+            signupmessage: db.SignupMessage = await db.run(db.SignupMessage.query().filter_by(is_open=True).first)
+            if signupmessage:
+                self.message_id, self.signup_id = signupmessage.message_id, signupmessage.id
+                # Covers signups opened before the job table existed, or a crash between opening and scheduling
+                await self.schedule_close(signupmessage)
+            else:
+                today = datetime.datetime.combine(datetime.datetime.utcnow().date(), datetime.time.min)
+                await self.schedule_open(today if today.weekday() == 5 else settings.next_day(5))
+            await self.load_signups()
+    
+    @staticmethod
+    async def schedule_open(day: datetime.datetime):
+        await jobs.add('open_signups', day, f'open_signups:{day.date().isoformat()}')
+    
+    @staticmethod
+    async def schedule_close(signupmessage: db.SignupMessage):
+        await jobs.add(
+            'close_signups', signupmessage.close_at, f'close_signups:{signupmessage.id}', signup_id=signupmessage.id
+        )
+    
+    async def open_signups_job(self, job: db.Job):
+        """Open signups on a Saturday, unless they're open already or were opened and closed this week."""
+        if datetime.datetime.utcnow().date() != job.run_at.date():
+            # The bot was down all day; wait for next week rather than opening signups late
+            logger.info(f'Not opening signups, as they were due on {job.run_at.date()}.')
+            return await self.schedule_open(settings.next_day(5))
+        signupmessages = await db.run(
+            db.SignupMessage.query().filter(
+                or_(db.SignupMessage.is_open.is_(True), db.SignupMessage.close_at > datetime.datetime.utcnow())
+            ).count
+        )
+        if signupmessages:
+            return logger.info(
+                'Not opening signups, as they are open or there is a signupmessage object with a closing date later '
+                'than now.'
+            )
+        logger.info('Opening signups')
+        await self.open_signups()
+    
+    async def close_signups_job(self, job: db.Job):
+        """Close the signups the job was scheduled for, if nobody closed them already, and schedule next week's."""
+        signupmessage = await db.run(db.SignupMessage.get, job.payload['signup_id'])
+        if signupmessage is not None and signupmessage.is_open:
+            logger.info('Closing signups.')
+            await self.close_signups()
+        await self.schedule_open(settings.next_day(5))
+    
+    async def create_matchups_job(self, job: db.Job):
+        await self.create_matchups(job=job)
     
     async def open_signups(self, manual=False, ping: str = None):
         if ping == 'noping':
@@ -186,13 +274,15 @@ class League(commands.Cog):
         
         day = settings.next_day(0)
         
-        db.SignupMessage(
+        signupmessage = db.SignupMessage(
             message_id=msg.id,
             is_open=True,
             close_at=day
-        ).save()
+        )
+        await db.run(signupmessage.save)
+        await self.schedule_close(signupmessage)
         
-        self.message_id = msg.id
+        self.message_id, self.signup_id = msg.id, signupmessage.id
         
         logger.info(
             f'Signups have been {"automatically " if not manual else ""}'
@@ -200,32 +290,36 @@ class League(commands.Cog):
         )
     
     async def close_signups(self, manual=False):
-        signup_message: db.SignupMessage = db.SignupMessage.query().filter_by(is_open=True).first()
+        signup_message: db.SignupMessage = await db.run(db.SignupMessage.query().filter_by(is_open=True).first)
         channel: TextChannel = self.bot.get_channel(
             int(self.conf['channels']['announcements'])
         )
         logger.debug(signup_message.message_id)
         msg = await channel.fetch_message(signup_message.message_id)
         
-        await msg.edit(content=settings.messages.SIGNUPS_CLOSED_MESSAGE.format(msg.content))
+        # A retried close job finds the message already edited; don't strike it through twice
+        closed_banner = settings.messages.SIGNUPS_CLOSED_MESSAGE.format('').rsplit('~~', 1)[1]
+        if not msg.content.endswith(closed_banner):
+            await msg.edit(content=settings.messages.SIGNUPS_CLOSED_MESSAGE.format(msg.content))
         await msg.clear_reactions()
         
-        signup_message.is_open = False
-        signup_message.save()
-        self.message_id = None
+        def close():
+            signup_message.is_open = False
+            if not manual:
+                # Scheduled in the same transaction, so closed signups always get their matchups exactly once
+                db.Job.schedule(
+                    'create_matchups', datetime.datetime.utcnow(), f'create_matchups:{signup_message.id}', commit=False
+                )
+            db.save()
+        
+        await db.run(close)
+        jobs.wake()
+        self.message_id, self.signup_id = None, None
         
         logger.info(
             f'Signups have been {"automatically " if not manual else ""}'
             f'closed.'
         )
-        
-        if not manual:
-            try:
-                await self.create_matchups()
-            except Exception as e:
-                await settings.discord_channel_log(
-                    f'Unhandled error (notifying <@{settings.owner_id}>): {e}'
-                )
     
     @commands.command(aliases=['close_signups', 'open_signups'])
     @settings.is_mod_check()
@@ -240,7 +334,7 @@ class League(commands.Cog):
         if ctx.invoked_with == 'close_signups':
             
             # Make sure there are actually signups open.
-            if not db.SignupMessage.query().filter_by(is_open=True).first():
+            if not await db.run(db.SignupMessage.query().filter_by(is_open=True).first):
                 return await ctx.send('Signups are not open, and therefore cannot be closed.')
             
             logger.debug(f'Close signups triggered manually by {ctx.author.name}/{ctx.author.id}')
@@ -251,7 +345,7 @@ class League(commands.Cog):
         elif ctx.invoked_with == 'open_signups':
             
             # Make sure there aren't signups already open
-            if db.SignupMessage.query().filter_by(is_open=True).first():
+            if await db.run(db.SignupMessage.query().filter_by(is_open=True).first):
                 return await ctx.send('Signups are already open, and more cannot be opened.')
             
             logger.debug(f'Open signups triggered manually by {ctx.author.name}/{ctx.author.id}')
@@ -261,232 +355,260 @@ class League(commands.Cog):
         else:
             await ctx.send(f'Run `{ctx.prefix}help signups` please.')
     
-    async def create_matchups(self):
-        logger.debug(f'Generating matchups')
-        
-        mobile_signups = db.Signup.query().filter(db.Signup.mobile.is_(True), db.Signup.player_id.isnot(None))
-        steam_signups = db.Signup.query().filter(db.Signup.mobile.is_(False), db.Signup.player_id.isnot(None))
+    async def create_matchups(
+            self, dry_run: bool = False, pool: List[Tuple[bool, db.Player]] = None, job: db.Job = None
+    ) -> dict:
+        """
+        Generate, save and announce this week's games from the signups.
         
-        if not mobile_signups.count() and not steam_signups.count():
-            return logger.info('Not creating matchups - no one has signed up.')
-        elif not mobile_signups.count():
+        With `dry_run`, nothing is saved, sent or deleted; the proposed games and messages are returned instead. `pool`
+        replaces the signups with ``(mobile, player)`` pairs, such as `synthetic_pool` makes; those players stand in
+        for their own discord users. `job` is marked done along with saving the games. Returns a report of the games,
+        rendered messages, removed players and how long each stage took in ms.
+        """
+        logger.debug(f'Generating matchups{" (dry run)" if dry_run else ""}')
+        report = {'games': {}, 'messages': [], 'removed': [], 'timings': {}}
+        clock = time.perf_counter()
+        
+        def lap(stage):
+            nonlocal clock
+            now = time.perf_counter()
+            report['timings'][stage] = (now - clock) * 1000
+            clock = now
+        
+        # First of all, get all the players, in one query
+        signups = None
+        if pool is None:
+            pool = signups = await db.run(
+                db.session.query(db.Signup.mobile, db.Player).join(db.Player, db.Player.id == db.Signup.player_id).all
+            )
+            get_user = self.bot.get_user
+        else:
+            get_user = {player.id: player for _, player in pool}.get
+        mobile_players = [player for mobile, player in pool if mobile]
+        steam_players = [player for mobile, player in pool if not mobile]
+        lap('load')
+        
+        if not mobile_players and not steam_players:
+            logger.info('Not creating matchups - no one has signed up.')
+            return report
+        elif not mobile_players:
             logger.info('Not creating matches for mobile - no signups')
-        elif not steam_signups.count():
+        elif not steam_players:
             logger.info('Not creating matches for steam - no signups')
         
-        # First of all, get all the players.
-        mobile_players = list(
-            filter(
-                lambda x: x.user is not None,
-                [
-                    x.player for x in mobile_signups.all()
-                ]
-            )
+        mobile_players = [player for player in mobile_players if get_user(player.id) is not None]
+        steam_players = [player for player in steam_players if get_user(player.id) is not None]
+        
+        report['removed'] = self.fix_parity(mobile_players, steam_players, self.pairing.random)
+        if not dry_run:
+            for player, platform, message in report['removed']:
+                outbox.send(player.id, message)
+                logger.info(f'{get_user(player.id)}/{player.id} kicked from {platform} matches.')
+        lap('parity')
+        
+        # Now that we have an even number of players on each platform, pair them up, avoiding recent rematches
+        await db.run(db.opponent_history.refresh)
+        mobile_pairs = self.pairing.pair([(player, get_user(player.id)) for player in mobile_players])
+        steam_pairs = self.pairing.pair([(player, get_user(player.id)) for player in steam_players])
+        lap('pairing')
+        
+        mobile_games, mobile_openings = self.make_games(mobile_pairs, True)
+        steam_games, steam_openings = self.make_games(steam_pairs, False)
+        report['games'] = {'mobile': mobile_games, 'steam': steam_games}
+        if dry_run:
+            # Stand in ids, so the messages render as they would; these games are never added to the session
+            for number, (game, _, _) in enumerate(mobile_openings + steam_openings, start=1):
+                game.id = number
+        else:
+            await db.run(self.save_games, mobile_openings + steam_openings, job, pool is signups)
+            deadlines.sync(*(game for game, _, _ in mobile_openings + steam_openings))
+            if pool is signups and (mobile_openings or steam_openings):
+                self.signed_up.clear()
+        lap('save')
+        
+        if not mobile_games and not steam_games:
+            return report
+        
+        tribe_tier = self.pairing.random.randint(1, 3)
+        blocks = self.announcement(mobile_games, steam_games, tribe_tier)
+        
+        if dry_run:
+            report['messages'] = list(blocks)
+            lap('render')
+            return report
+        
+        # Blocks are rendered as they're sent, so the first goes out before later tiers have been rendered
+        chan: TextChannel = self.bot.get_channel(int(self.conf['channels']['matchups']))
+        for block in blocks:
+            report['messages'].append(block)
+            await chan.send(block)
+        lap('announce')
+        return report
+    
+    @staticmethod
+    def announcement(mobile_games: Dict[int, List[db.Game]], steam_games: Dict[int, List[db.Game]], tribe_tier: int):
+        """Yield the matchups announcement as messages that fit in discord's limit, rendering lazily."""
+        yield (
+            f'A new week of games has been generated!\nWe will be using **Level {tribe_tier}** tribes this week.\n'
+            f'Here are your games:'
         )
-        steam_players = list(
-            filter(
-                lambda x: x.user is not None,
-                [
-                    x.player for x in steam_signups.all()
-                ]
-            )
+        for platform, games in (('Mobile', mobile_games), ('Steam', steam_games)):
+            if games:
+                yield from settings.chunk_lines(
+                    itertools.chain(['\n\n'], MATCHUPS_TEMPLATE.generate(gms=games, platform=platform))
+                )
+        yield (
+            '\n\nPlease create your games as soon as possible. '
+            'If your game has not $started in the next 72 hours (3 days), '
+            'the away player will become the host. If the new host does not '
+            'start the game 72 hours after that, the game will be cancelled.'
         )
+    
+    @staticmethod
+    def fix_parity(mobile_players: List[db.Player], steam_players: List[db.Player], rng: random.Random) -> List[tuple]:
+        """
+        Remove players until both platforms have an even number, preferring players who signed up for both.
         
-        mobile_players_even = len(mobile_players) % 2 == 0
-        steam_players_even = len(steam_players) % 2 == 0
-        
-        if not mobile_players_even or not steam_players_even:
-            
-            async def remove_random(member_list: List, platform):
-                pl = member_list.pop(random.randint(0, len(member_list) - 1))
-                m: User = self.bot.get_user(pl.id)
-                try:
-                    await m.send(
-                        f'You have been randomly removed from the {platform} matchups for this week\'s PolyLadder '
-                        f'games. Sorry!'
-                    )
-                except discord.Forbidden:
-                    pass
-                logger.info(f'{m.name}#{m.discriminator}/{m.id} kicked from {platform} matches.')
-            
-            # We don't have an even number of players. Kick one of them.
-            duplicates = set(mobile_players) & set(steam_players)
-            if not duplicates:
-                # No players have signed up for both steam and mobile
-                pass
-                if not mobile_players_even:
-                    await remove_random(mobile_players, 'mobile')
-                if not steam_players_even:
-                    await remove_random(steam_players, 'steam')
+        Edits the lists in place and returns ``(player, platform, message to send them)`` for everyone removed.
+        """
+        removed = []
+        
+        def remove_random(players: List[db.Player], platform):
+            player = players.pop(rng.randrange(len(players)))
+            removed.append((
+                player, platform,
+                f'You have been randomly removed from the {platform} matchups for this week\'s PolyLadder games. Sorry!'
+            ))
+        
+        def remove_duplicate(players: List[db.Player], platform):
+            player = duplicates.pop(rng.randrange(len(duplicates)))
+            players.remove(player)
+            removed.append((
+                player, platform,
+                f'You have been removed from {platform} matchups for this week\'s PolyLadder matches, '
+                f'due to player limits and to you signing up for both steam and mobile.'
+            ))
+        
+        # Players who have signed up for both steam and mobile
+        duplicates = sorted(set(mobile_players) & set(steam_players), key=lambda player: player.id)
+        mobile_odd, steam_odd = len(mobile_players) % 2, len(steam_players) % 2
+        
+        if mobile_odd:
+            if duplicates:
+                remove_duplicate(mobile_players, 'mobile')
             else:
-                # There are duplicate players - player's who have signed up for both platforms.
-                if len(duplicates) > 1:
-                    if not mobile_players_even:
-                        # mobile
-                        p = duplicates.pop()
-                        member = self.bot.get_user(p.id)
-                        await member.send(
-                            'You have been removed from mobile matchups for this week\'s PolyLadder matches, '
-                            'due to player limits and to you signing up for both steam and mobile.'
-                        )
-                        mobile_players.remove(p)
-                        logger.info(f'{member.name}#{member.discriminator}/{member.id} kicked from mobile matches.')
-                    if not steam_players_even:
-                        # steam
-                        p = duplicates.pop()
-                        member = self.bot.get_user(p.id)
-                        await member.send(
-                            'You have been removed from steam matchups for this week\'s PolyLadder matches, '
-                            'due to player limits and to you signing up for both steam and mobile.'
-                        )
-                        steam_players.remove(p)
-                        logger.info(f'{member.name}#{member.discriminator}/{member.id} kicked from steam matches.')
-                else:
-                    if not mobile_players_even:
-                        # Only 1 duplicate
-                        p = duplicates.pop()
-                        member = self.bot.get_user(p.id)
-                        await member.send(
-                            'You have been removed from mobile matchups for this week\'s PolyLadder matches, '
-                            'due to player limits and to you signing up for both steam and mobile.'
-                        )
-                        mobile_players.remove([p, member])
-                        logger.info(f'{member.name}#{member.discriminator}/{member.id} kicked from mobile matches.')
-                    if not steam_players_even:
-                        await remove_random(steam_players, 'steam')
-        
-        # Load the discord member objects
-        mobile: List[List[db.Player, Member]] = list()
-        steam: List[List[db.Player, Member]] = list()
-        
-        for player in mobile_players:
-            user = self.bot.get_user(player.id)
-            if player is None or user is None:
-                continue
-            mobile.append(
-                [player, user]
-            )
-        for player in steam_players:
-            user = self.bot.get_user(player.id)
-            if player is None or user is None:
-                continue
-            steam.append(
-                [player, user]
-            )
-        
-        # Now that we have an even number of players in each tier, start generating matchups
-        # Create the tier objects
-        mobile_tiers: Dict[int, list] = {
-            x: [] for x in range(1, 13)
-        }
-        steam_tiers: Dict[int, list] = {
-            x: [] for x in range(1, 13)
-        }
-        
-        # Place people in their initial rungs.
-        for player, member in mobile:
-            mobile_tiers[player.rung].append(
-                (player, member)
-            )
-        
-        for player, member in steam:
-            steam_tiers[player.rung].append(
-                (player, member)
-            )
-        
-        # Iterate through each rung, from the bottom up, and move people up if there's an odd
-        # number of people in that rung.
-        
-        for tiers in [mobile_tiers, steam_tiers]:
-            for r in range(1, 13):
-                rung = tiers[r]
-                if len(rung) % 2 == 0:
-                    continue
-                rung.sort(key=lambda x: x[0].wins().count())
-                tiers[r + 1].append(rung.pop(0))
-        
-        # Rungs are sorted, create the matchups
-        mobile_games = self.make_games(mobile_tiers, True)
-        steam_games = self.make_games(steam_tiers, False)
-        
-        platform_msg_source = Template(
-            """
-**{{platform}}**:\n
-{% for tier, games in gms.items() if games is not none %}
-Tier {{tier}} matchups:
-{% for game in games %}
-<@{{game.host.id}}> ({{game.host_step}}) hosts vs <@{{game.away_id}}> ({{game.away_step}}) - Game {{game.id}}
-{% endfor %}
-
-
-{% endfor %}
-"""
-        )
+                remove_random(mobile_players, 'mobile')
+        if steam_odd:
+            if duplicates:
+                remove_duplicate(steam_players, 'steam')
+            else:
+                remove_random(steam_players, 'steam')
+        return removed
+    
+    @staticmethod
+    def synthetic_pool(players: int, rng: random.Random) -> List[Tuple[bool, db.Player]]:
+        """Signups for `players` made up players on random rungs, about a tenth of them on both platforms."""
+        pool = []
+        for i in range(1, players + 1):
+            player = db.Player(id=i, name=f'player{i}', ign=f'ign{i}', steam_name=f'steam{i}', rung=rng.randint(1, 12))
+            platform = rng.random()
+            if platform < 0.55:
+                pool.append((True, player))
+            if platform >= 0.45:
+                pool.append((False, player))
+        return pool
+    
+    @staticmethod
+    def make_games(pairs: List[tuple], mobile: bool) -> Tuple[Dict[int, List[db.Game]], List[tuple]]:
+        """
+        Build a game for each ``((player, user), (player, user))`` pair, played at the higher of the two rungs.
         
-        if mobile_games or steam_games:
-            chan: TextChannel = self.bot.get_channel(int(self.conf['channels']['matchups']))
-            tribe_tier = random.randint(1, 3)
-            await chan.send(
-                f'A new week of games has been generated!\nWe will be using **Level {tribe_tier}** tribes this week.\n'
-                f'Here are your games:'
-            )
-            if mobile_games:
-                message = f'\n\n{platform_msg_source.render(gms=mobile_games, platform="Mobile")}'
-                
-                for block in settings.split_string(message):
-                    await chan.send(block)
-            if steam_games:
-                message = f'\n\n{platform_msg_source.render(gms=steam_games, platform="Steam")}'
-                for block in settings.split_string(message):
-                    await chan.send(block)
-            await chan.send(
-                '\n\nPlease create your games as soon as possible. '
-                'If your game has not $started in the next 72 hours (3 days), '
-                'the away player will become the host. If the new host does not '
-                'start the game 72 hours after that, the game will be cancelled.'
+        Nothing is written here; returns the games by tier, and ``(game, host_user, away_user)`` for `save_games`.
+        """
+        out = {}
+        openings = []
+        now = datetime.datetime.utcnow()
+        for host, away in pairs:
+            tier_number = max(host[0].rung, away[0].rung)
+            game = db.Game(
+                host_id=host[0].id,
+                away_id=away[0].id,
+                host_step=host[0].rung,
+                away_step=away[0].rung,
+                mobile=mobile,
+                opened_ts=now,
+                step=tier_number
             )
-            mobile_signups.delete()
-            steam_signups.delete()
-            
-            db.save()
+            out.setdefault(tier_number, []).append(game)
+            openings.append((game, host[1], away[1]))
+        return dict(sorted(out.items())), openings
     
     @staticmethod
-    def make_games(tiers: Dict[int, list], mobile: bool):
-        out = {
-            x: [] for x in range(1, 13)
-        }
-        tiers_to_delete = []
-        for tier_number, players in tiers.items():
-            tiers[tier_number] = []
-            if not players:
-                tiers_to_delete.append(tier_number)
-                continue
-            random.shuffle(players)
-            players = iter(players)
-            for host, away in zip(players, players):
-                game = db.Game(
-                    host_id=host[0].id,
-                    away_id=away[0].id,
-                    host_step=host[0].rung,
-                    away_step=away[0].rung,
-                    mobile=mobile,
-                    opened_ts=datetime.datetime.utcnow(),
-                    step=tier_number
+    def save_games(openings: List[tuple], job: db.Job = None, clear_signups: bool = False):
+        """
+        Insert the games from `make_games` and their log entries in a single transaction, so either every game for the
+        week exists or none do. With `clear_signups`, the signups they were made from are deleted in the same
+        transaction, as long as there is a game; signups that paired into no games are kept. `job`, the job generating
+        them, is marked done in it too, so a failure or restart afterwards can neither save the week's games twice nor
+        pair the same signups again. Runs on the database thread.
+        """
+        try:
+            db.session.add_all(game for game, _, _ in openings)
+            # One batched INSERT ... RETURNING to get the ids the log entries need
+            db.session.flush()
+            db.session.add_all(
+                db.GameLog.entry(
+                    game_id=game.id,
+                    message=f'Game opened by me. {db.GameLog.member_string(host)} hosts against '
+                            f'{db.GameLog.member_string(away)}'
                 )
-                game.save()
-                db.GameLog.write(game_id=game.id,
-                                 message=f'Game opened by me. {db.GameLog.member_string(host[1])} hosts against '
-                                         f'{db.GameLog.member_string(away[1])}'
-                                 )
-                out[tier_number].append(game)
-        for t in tiers_to_delete:
-            del out[t]
-        return out
+                for game, host, away in openings
+            )
+            if clear_signups and openings:
+                db.Signup.query().filter(db.Signup.player_id.isnot(None)).delete(synchronize_session=False)
+            if job is not None:
+                job.finish(commit=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        
+        for game, _, _ in openings:
+            db.opponent_history.add(game.host_id, game.away_id)
     
     @commands.command()
     @commands.is_owner()
-    async def gen(self, _ctx: commands.Context = None):
-        await self.create_matchups()
+    async def gen(self, ctx: commands.Context = None, mode: str = None, players: int = 1000):
+        """
+        *Owner*: generate this week's games from the signups.
+        
+        - [p]gen - generate, save and announce the games
+        - [p]gen dry - show the games that would be generated, without saving or sending anything
+        - [p]gen simulate 5000 - time a dry run for 5000 made up players
+        """
+        if mode is None:
+            return await self.create_matchups()
+        if mode not in ('dry', 'simulate'):
+            return await ctx.send(f'Run `{ctx.prefix}help gen` please.')
+        
+        async with ctx.typing():
+            pool = self.synthetic_pool(players, self.pairing.random) if mode == 'simulate' else None
+            report = await self.create_matchups(dry_run=True, pool=pool)
+        
+        games = report['games']
+        summary = [
+            f'**{platform.title()}**: {sum(len(tier) for tier in tiers.values())} games '
+            f'({", ".join(f"tier {tier}: {len(tier_games)}" for tier, tier_games in tiers.items()) or "none"})'
+            for platform, tiers in games.items()
+        ]
+        summary.append(f'{len(report["removed"])} players removed to even out the platforms.')
+        summary.append(', '.join(f'{stage} {ms:.1f}ms' for stage, ms in report['timings'].items()))
+        await ctx.send('\n'.join(summary))
+        
+        if mode == 'dry':
+            for message in report['messages']:
+                await ctx.send(message, allowed_mentions=AllowedMentions.none())
     
     @commands.command()
     @settings.is_in_bot_channel()
@@ -1,11 +1,14 @@
 # Copyright (c) 2021 Jasper Harrison. This file is licensed under the terms of the Apache license, version 2.0. #
 from typing import List
 
+import asyncio
+import contextlib
 import datetime
-from discord import Member, TextChannel, utils
+from discord import AllowedMentions, Member, TextChannel, utils
 from discord.ext import commands, tasks
 
-from ladderbot import settings, db
+from ladderbot import settings, db, scheduler
+from .scheduler import deadlines
 from .logging import logger
 
 
@@ -23,10 +26,10 @@ class Matchmaking(commands.Cog):
         drafts: TextChannel = self.bot.get_channel(int(self.conf['channels']['drafts']))
         
         message = (
-            f'New game ID {game.id} started! Roster: {game.host.mention} {game.away.mention}'
+            f'New game ID {game.id} started! Roster: <@{game.host_id}> <@{game.away_id}>'
         )
         
-        await drafts.send(message, embed=game.embed(guild))
+        await drafts.send(message, embed=await db.run(game.embed, guild))
         await channel.send(
             f'Game ID {game.id} has been started! Check {drafts.mention} for more information.'
         )
@@ -35,114 +38,109 @@ class Matchmaking(commands.Cog):
         drafts: TextChannel = self.bot.get_channel(int(self.conf['channels']['drafts']))
         
         message = (
-            f'Game ID {game.id} completed! Congrats {game.winner.mention}! '
-            f'Roster: {game.host.mention} {game.away.mention}'
+            f'Game ID {game.id} completed! Congrats <@{game.winner_id}>! '
+            f'Roster: <@{game.host_id}> <@{game.away_id}>'
         )
-        await drafts.send(message, embed=game.embed(guild))
+        await drafts.send(message, embed=await db.run(game.embed, guild))
         await channel.send(message)
         await channel.send('All sides have confirmed this victory. Good game!')
     
-    @tasks.loop(minutes=30)
+    @tasks.loop(seconds=0)
     async def loop(self):
+        # Sleeps until the next deadline, then runs only the passes that have something due
+        due = await deadlines.wait()
+        try:
+            async with db.scope():
+                await self.run_passes(due)
+        except Exception as e:
+            # Keep the loop, and the deadlines that were due, for another try
+            deadlines.retry()
+            logger.exception(f'Deadline passes failed, retrying in {scheduler.RETRY_AFTER}: {e}')
+            with contextlib.suppress(Exception):
+                await settings.discord_channel_log(
+                    f'Deadline passes failed, retrying in {scheduler.RETRY_AFTER} '
+                    f'(notifying <@{settings.owner_id}>): {e}'
+                )
+    
+    async def run_passes(self, due: set):
+        # Each pass runs in one transaction on a database thread; announcements go out together once it's committed
+        guild = self.bot.get_guild(settings.server_id)
+        drafts: TextChannel = self.bot.get_channel(int(self.conf['channels']['drafts']))
+        now = datetime.datetime.utcnow()
+        
         # Autoconfirm loop
-        logger.debug('Running autoconfirm loop')
-        
-        unconfirmed = db.Game.query().filter(
-            db.Game.is_complete.is_(True) &
-            db.Game.is_confirmed.is_(False)
-        ).filter(db.Game.win_claimed_ts < datetime.datetime.utcnow() - datetime.timedelta(hours=24))
-        
-        for game in unconfirmed.all():
-            game: db.Game
-            game.win_confirmed(game.winner_id)
-            await game.process_win()
-            await self.announce_end(
-                self.bot.get_guild(settings.server_id), self.bot.get_channel(int(self.conf['channels']['logs'])), game
-            )
-            await settings.discord_channel_log(
-                f'Game {game.id} autoconfirmed. Win claimed more than 24 hours ago. 1 of 2 sides had confirmed.'
-            )
-            logger.info(
-                f'Game {game.id} autoconfirmed. Win claimed more than 24 hours ago. 1 of 2 sides had confirmed.'
-            )
-        if unconfirmed.count() != 0:
-            logger.info(f'Autoconfirm process complete. {unconfirmed.count()} games confirmed.')
-            await settings.discord_channel_log(f'Autoconfirm process complete. {unconfirmed.count()} games confirmed.')
+        if scheduler.AUTOCONFIRM in due:
+            logger.debug('Running autoconfirm loop')
+            
+            confirmed = await db.run(db.Game.autoconfirm, now - scheduler.AUTOCONFIRM_AFTER)
+            deadlines.sync(*confirmed)
+            
+            async def announce_confirmed(game: db.Game):
+                message = (
+                    f'Game {game.id} autoconfirmed. Win claimed more than 24 hours ago. 1 of 2 sides had confirmed.'
+                )
+                logger.info(message)
+                await self.announce_end(guild, self.bot.get_channel(int(self.conf['channels']['logging'])), game)
+                await settings.discord_channel_log(message)
+            
+            await asyncio.gather(*(announce_confirmed(game) for game in confirmed))
+            if confirmed:
+                logger.info(f'Autoconfirm process complete. {len(confirmed)} games confirmed.')
+                await settings.discord_channel_log(f'Autoconfirm process complete. {len(confirmed)} games confirmed.')
         
         # Game deletion/host switching loop
-
-        to_delete = db.Game.query().filter(
-            db.Game.is_started.is_(False),
-            db.Game.host_switched.is_(True),
-            db.Game.opened_ts < datetime.datetime.utcnow() - datetime.timedelta(days=6)
-        )
-        
-        for game in to_delete:
-            logger.info(f'Deleting full game {game.id} as it was never started.')
-            db.GameLog.write(
-                game_id=game.id,
-                message=f'Game automatically deleted after reaching 6 day limit.'
-            )
-            drafts: TextChannel = self.bot.get_channel(int(self.conf['channels']['drafts']))
-
+        deleted, switched = [], []
+        if scheduler.EXPIRE in due:
+            deleted = await db.run(db.Game.delete_unstarted, now - scheduler.EXPIRE_AFTER)
+            for game in deleted:
+                deadlines.cancel(game.id)
+        
+        async def announce_deleted(game: db.Game):
+            logger.info(f'Deleted full game {game.id} as it was never started.')
             await drafts.send(
-                f'Game ID {game.id} has been deleted as {game.host.mention} never started it :rage:. '
-                f'Notifying players {game.host.mention} {game.away.mention}'
+                f'Game ID {game.id} has been deleted as <@{game.host_id}> never started it :rage:. '
+                f'Notifying players <@{game.host_id}> <@{game.away_id}>'
             )
             await settings.discord_channel_log(
                 f'Game {game.id} automatically deleted after reaching 6 day limit.'
             )
-            game.delete()
-            
+        
         # Games that aren't started
-        to_switch = db.Game.query().filter(
-            db.Game.is_started.is_(False),
-            db.Game.host_switched.is_(False),
-            db.Game.opened_ts < datetime.datetime.utcnow() - datetime.timedelta(days=3)
-        )
+        if scheduler.SWITCH_HOST in due:
+            switched = await db.run(db.Game.switch_hosts, now - scheduler.SWITCH_HOST_AFTER)
+            # Switched games are now due to expire
+            deadlines.sync(*switched)
         
-        for game in to_switch:
-            logger.info(f'Switching host on game {game.id}')
-            game: db.Game
-            host, host_step = game.host, game.host_step
-            away, away_step = game.away, game.away_step
-            game.host = away
-            game.host_step = away_step
-            game.away = host
-            game.away_step = host_step
-            game.host_switched = True
-            
+        async def announce_switched(game: db.Game):
+            logger.info(f'Switched host on game {game.id}')
             new_host, new_away = game.host, game.away
-            
-            game.save()
-            
-            drafts: TextChannel = self.bot.get_channel(int(self.conf['channels']['drafts']))
-            
             await drafts.send(
                 f'{new_host.mention} has become the host for Game ID {game.id} as {new_away.mention} '
                 f'never started it :rage:.'
             )
-            db.GameLog.write(
-                game_id=game.id,
-                message=f'Host changed from {db.GameLog.member_string(new_away)} to '
-                        f'{db.GameLog.member_string(new_host)} as the game was not started in time.'
-            )
             await settings.discord_channel_log(
                 f'{new_host.mention} has become the host for Game ID {game.id} as {new_away.mention} '
                 f'never started it.'
             )
         
-        if to_switch.count() != 0:
-            logger.info(f'Host switch process complete. {unconfirmed.count()} games switched.')
-            await settings.discord_channel_log(f'Host switch process complete. {unconfirmed.count()} games switched.')
+        await asyncio.gather(
+            *(announce_deleted(game) for game in deleted), *(announce_switched(game) for game in switched)
+        )
+        
+        if switched:
+            logger.info(f'Host switch process complete. {len(switched)} games switched.')
+            await settings.discord_channel_log(f'Host switch process complete. {len(switched)} games switched.')
         
-        if to_delete.count() != 0:
-            logger.info(f'Host switch process complete. {unconfirmed.count()} games deleted.')
-            await settings.discord_channel_log(f'Host switch process complete. {unconfirmed.count()} games deleted.')
+        if deleted:
+            logger.info(f'Host switch process complete. {len(deleted)} games deleted.')
+            await settings.discord_channel_log(f'Host switch process complete. {len(deleted)} games deleted.')
 
     @loop.before_loop
     async def pre_loop(self):
         await self.bot.wait_until_ready()
+        async with db.scope():
+            deadlines.load(await db.run(deadlines.pending))
+        logger.debug(f'Loaded {len(deadlines)} game deadlines')
     
     @commands.command(aliases=['steamname'])
     async def setname(self, ctx: commands.Context, *, args=None):
@@ -178,7 +176,7 @@ class Matchmaking(commands.Cog):
         
         steam = ctx.invoked_with == 'steamname'
         
-        player = db.Player.query().filter(db.Player.id == dest.id).first()
+        player = await db.run(db.Player.get, dest.id)
         created = True if player else False
         
         if player:
@@ -186,7 +184,7 @@ class Matchmaking(commands.Cog):
                 setattr(player, 'steam_name' if steam else 'ign', utils.escape_mentions(name))
             else:
                 setattr(player, 'steam_name' if steam else 'ign', name)
-            player.save()
+            await db.run(player.save)
             
             await ctx.send(
                 f'{dest.mention} has been updated'
@@ -202,25 +200,21 @@ class Matchmaking(commands.Cog):
                     id=dest.id,
                     ign=name
                 )
-            player.save()
+            await db.run(player.save)
             
             await ctx.send(
                 f'{dest.mention} has successfully registered themselves with me on '
                 f'{"**steam**" if steam else "**mobile**"}.'
             )
         
+        if league := self.bot.get_cog('League'):
+            league.update_player(player)
+        
         if name is not None:
             await settings.fix_roles(ctx.author, dest)
-            if steam:
-                alts = db.Player.query().filter(
-                    db.Player.steam_name.ilike(name)
-                )
-            else:
-                alts = db.Player.query().filter(
-                    db.Player.ign.ilike(name)
-                )
-            if alts.count() > 1:
-                mod_role = utils.get(ctx.guild.roles, name='Mod')
+            alts = await db.run(db.Player.alts(name, steam).all)
+            if len(alts) > 1:
+                mod_role = settings.role_registry.of(ctx.guild)['Mod']
                 msg = (
                     f':warning: This polytopia name is already entered in the database. '
                     f'If you need help using this bot please contact a {mod_role.mention} or <@{settings.owner_id}>.'
@@ -228,7 +222,22 @@ class Matchmaking(commands.Cog):
                 )
                 return await ctx.send(msg)
             
-        db.GameLog.write(
+            similar = db.Player.search(name, db.Player.steam_name if steam else db.Player.ign)
+            similar = [
+                alt for alt, score in await db.run(similar.limit(5).all) if alt.id != dest.id and score >= 0.6
+            ]
+            if similar:
+                names = ', '.join(
+                    f'{alt.mention} (`{utils.escape_markdown(alt.steam_name if steam else alt.ign)}`)' for alt in similar
+                )
+                await settings.discord_channel_log(
+                    f'{dest.mention} set their {"steam" if steam else "mobile"} name to '
+                    f'`{utils.escape_markdown(name)}`, which is similar to: {names}',
+                    allowed_mentions=AllowedMentions(users=False, roles=False)
+                )
+            
+        await db.run(
+            db.GameLog.write,
             f'{db.GameLog.member_string(dest)} {"steam" if steam else "mobile"} username '
             f'{"set" if created else "updated"} to `{utils.escape_markdown(name) if name else name}`'
         )
@@ -248,9 +257,9 @@ class Matchmaking(commands.Cog):
                 members = await settings.get_member(ctx, member)
     
             if not members:
-                players = db.Player.get_by_name(member, return_all=True).all()
+                players = await db.run(lambda: db.Player.get_by_name(member, return_all=True).all())
             else:
-                players: List[db.Player] = [db.Player.get(m.id) for m in members]
+                players: List[db.Player] = [await db.run(db.Player.get, m.id) for m in members]
     
             player: db.Player
             
@@ -303,7 +312,7 @@ class Matchmaking(commands.Cog):
         if game.is_started is True:
             return await ctx.send(f'Game ID {game.id} has already started with name **{game.name}**.')
         
-        if ctx.author.id != game.host.id:
+        if ctx.author.id != game.host_id:
             if not settings.is_mod(ctx.author):
                 return await ctx.send(f'Only the game host or a **@Mod** can do this.')
         
@@ -317,12 +326,14 @@ class Matchmaking(commands.Cog):
         game.is_started = True
         game.started_ts = datetime.datetime.utcnow()
         
-        game.save()
+        await db.run(game.save)
+        deadlines.sync(game)
         
         await self.announce_start(ctx.guild, ctx.channel, game)
         await settings.fix_roles(ctx.author)
         
-        db.GameLog.write(
+        await db.run(
+            db.GameLog.write,
             game_id=game.id,
             message=f'{db.GameLog.member_string(ctx.author)} started game with name '
                     f'**{utils.escape_markdown(game.name)}**'
@@ -351,7 +362,7 @@ class Matchmaking(commands.Cog):
         elif game.is_complete:
             return await ctx.send('This game is completed. You cannot rename completed games.')
         
-        if ctx.author.id != game.host.id:
+        if ctx.author.id != game.host_id:
             if not settings.is_mod(ctx.author):
                 return await ctx.send(f'Only the game host or a **@Mod** can do this.')
         
@@ -363,11 +374,12 @@ class Matchmaking(commands.Cog):
         
         old_name = game.name
         game.name = utils.escape_mentions(game_name) if game_name else game_name
-        game.save()
+        await db.run(game.save)
         
         await ctx.send(f'Game {game.id} has been renamed to '
                        f'"**{utils.escape_mentions(game_name) if game_name else game_name}**" from "**{old_name}**".')
-        db.GameLog.write(
+        await db.run(
+            db.GameLog.write,
             game_id=game.id,
             message=f'{db.GameLog.member_string(ctx.author)} renamed the game to '
                     f'**{utils.escape_markdown(game.name)}**'
@@ -387,16 +399,18 @@ class Matchmaking(commands.Cog):
         if not game:
             return await ctx.send('Game ID not provided.')
         
-        host: Member
-        away: Member
+        host: db.Player
+        away: db.Player
         winner: db.Player
         
-        if ctx.author.id not in (game.host.id, game.away.id) and not settings.is_mod(ctx.author):
+        host, away = await db.run(lambda: (game.host, game.away))
+        
+        if ctx.author.id not in (game.host_id, game.away_id) and not settings.is_mod(ctx.author):
             return await ctx.send(f'You are not a participant in game {game.id}.')
         if not game.is_started:
             return await ctx.send(f'Game ID {game.id} has not yet started.')
         if game.is_complete or game.is_confirmed:
-            winner = game.winner
+            winner = host if game.winner_id == host.id else away
             if game.is_confirmed:
                 return await ctx.send(
                     f'Game {game.id} is already completed with winner **{winner.name}**'
@@ -405,13 +419,13 @@ class Matchmaking(commands.Cog):
         if not winner_str:
             return await ctx.send(
                 f'Sides in this game are:\n'
-                f'Side 1 (host): **{utils.escape_markdown(game.host.name)}**\n'
-                f'Side 2 (away): **{utils.escape_markdown(game.away.name)}**'
+                f'Side 1 (host): **{utils.escape_markdown(host.name)}**\n'
+                f'Side 2 (away): **{utils.escape_markdown(away.name)}**'
             )
         
         winning_side: Member = await settings.get_member_raw(ctx, winner_str)
         if not winning_side:
-            matches = db.Player.get_by_name(winner_str, True, in_game_id=game.id).all()
+            matches = await db.run(lambda: db.Player.get_by_name(winner_str, True, in_game_id=game.id).all())
             if len(matches) == 2:
                 return await ctx.send(
                     f'"{winner_str}" matches both sides in game {game.id}. Please be more specific, or use a @Mention'
@@ -421,22 +435,23 @@ class Matchmaking(commands.Cog):
             else:
                 return await ctx.send(
                     f'Sides in this game are:\n'
-                    f'Side 1 (host): {game.host.name}\n'
-                    f'Side 2 (away): {game.away.name}'
+                    f'Side 1 (host): {host.name}\n'
+                    f'Side 2 (away): {away.name}'
                 )
         
-        if settings.is_mod(ctx.author) and ctx.author.id not in (game.host.id, game.away.id):
+        if settings.is_mod(ctx.author) and ctx.author.id not in (game.host_id, game.away_id):
             # author is a mod, and not in the game. Mark as won.
-            db.GameLog.write(
+            await db.run(
+                db.GameLog.write,
                 game_id=game.id,
                 message=f'Win claim logged by {db.GameLog.member_string(ctx.author)} for winner '
                         f'**{utils.escape_markdown(winning_side.name)}**'
             )
-            game.win_confirmed(winning_side.id)
-            await game.process_win()
+            await db.run(game.win_confirmed, winning_side.id)
+            deadlines.sync(game)
             self.bot.loop.create_task(
                 settings.fix_roles(
-                    ctx.author, game.host.member(ctx.guild), game.away.member(ctx.guild)
+                    ctx.author, host.member(ctx.guild), away.member(ctx.guild)
                 )
             )
             return await self.announce_end(ctx.guild, ctx.channel, game)
@@ -448,26 +463,29 @@ class Matchmaking(commands.Cog):
                     await ctx.send(f'You have already logged a win claim.')
                 else:
                     # This player hasn't logged a win confirm yet; confirm the game.
-                    db.GameLog.write(
+                    await db.run(
+                        db.GameLog.write,
                         game_id=game.id,
                         message=f'Win claim logged by {db.GameLog.member_string(ctx.author)} for winner '
                                 f'**{utils.escape_markdown(winning_side.name)}**'
                     )
-                    game.win_confirmed(winning_side.id)
-                    await game.process_win()
+                    await db.run(game.win_confirmed, winning_side.id)
+                    deadlines.sync(game)
                     self.bot.loop.create_task(
                         settings.fix_roles(
-                            ctx.author, game.host.member(ctx.guild), game.away.member(ctx.guild)
+                            ctx.author, host.member(ctx.guild), away.member(ctx.guild)
                         )
                     )
                     return await self.announce_end(ctx.guild, ctx.channel, game)
             else:
-                db.GameLog.write(
+                await db.run(
+                    db.GameLog.write,
                     game_id=game.id,
                     message=f'Win claim logged by {db.GameLog.member_string(ctx.author)} for winner '
                             f'**{utils.escape_markdown(winning_side.name)}**'
                 )
-                db.GameLog.write(
+                await db.run(
+                    db.GameLog.write,
                     game_id=game.id,
                     message=f'Conflicting win claims; cancelling them.'
                 )
@@ -476,45 +494,45 @@ class Matchmaking(commands.Cog):
                 await ctx.send(
                     f':warning: game {game.id} already has {logged_winner.name} as the logged winner!'
                 )
-                game.is_complete = False
-                game.winner_id = None
-                game.win_claimed_ts = None
-                game.win_claimed_by = None
-                game.is_confirmed = False
-                game.save()
+                await db.run(game.reset_win)
+                deadlines.sync(game)
                 return await ctx.send(
                     f'All win claims for this game have been **reset** due to there being conflicting win claims.\n'
-                    f'Notifying players {game.host.mention} {game.away.mention}'
+                    f'Notifying players {host.mention} {away.mention}'
                 )
         elif game.winner_id is None:
             # No win claim has been logged yet.
             if winning_side.id != ctx.author.id:
                 # Win claim is for the other side - automatically confirm it
-                db.GameLog.write(
+                await db.run(
+                    db.GameLog.write,
                     game_id=game.id,
                     message=f'Win claim logged by {db.GameLog.member_string(ctx.author)} for winner '
                             f'**{utils.escape_markdown(winning_side.name)}**'
                 )
-                game.win_confirmed(winning_side.id)
-                await game.process_win()
+                await db.run(game.win_confirmed, winning_side.id)
+                deadlines.sync(game)
                 self.bot.loop.create_task(
                     settings.fix_roles(
-                        ctx.author, game.host.member(ctx.guild), game.away.member(ctx.guild)
+                        ctx.author, host.member(ctx.guild), away.member(ctx.guild)
                     )
                 )
                 return await self.announce_end(ctx.guild, ctx.channel, game)
             # win claim is not for the other side. Don't autoconfirm.
-            db.GameLog.write(
+            await db.run(
+                db.GameLog.write,
                 game_id=game.id,
                 message=f'Win claim logged by {db.GameLog.member_string(ctx.author)} for winner '
                         f'**{utils.escape_markdown(winning_side.name)}**'
             )
-            game.win_unconfirmed(winning_side.id, ctx.author.id)
+            await db.run(game.win_unconfirmed, winning_side.id, ctx.author.id)
+            deadlines.sync(game)
+            winner = host if game.winner_id == host.id else away
             await ctx.send(
                 f'Game {game.id} completed pending confirmation of winner {winning_side.mention}.\n'
                 f'To confirm, have opponents use the command `$win {game.id} '
-                f'{game.winner.name if "@" in winner_str else winner_str}`.\n'
-                f'Notifying {game.host.mention} {game.away.mention}.'
+                f'{winner.name if "@" in winner_str else winner_str}`.\n'
+                f'Notifying {host.mention} {away.mention}.'
             )
     
     @commands.command()
@@ -534,9 +552,11 @@ class Matchmaking(commands.Cog):
         game.is_started = False
         game.is_name = None
         game.started_ts = None
-        game.save()
+        await db.run(game.save)
+        deadlines.sync(game)
 
-        db.GameLog.write(
+        await db.run(
+            db.GameLog.write,
             game_id=game.id,
             message=f'{db.GameLog.member_string(ctx.author)} changed in-progress game to pending game. '
                     f'(`{ctx.prefix}unstart`)'
@@ -555,44 +575,24 @@ class Matchmaking(commands.Cog):
         if not game.is_complete:
             return await ctx.send(f'Game {game.id} is not marked as completed.')
         
-        # Load the objects
-        host = db.Player.get(game.host_id)
-        away = db.Player.get(game.away_id)
-        away_rung, host_rung = away.rung, host.rung
-        
-        host_member, away_member = ctx.guild.get_member(game.host_id), ctx.guild.get_member(game.away_id)
-        
-        if game.host_step_change is not None or game.away_step_change is not None:
-            # reverse rung changes
-            if game.host_step_change < 0:
-                if game.host_step != 1:
-                    host_rung = max(min(host.rung - game.host_step_change, 12), 1)
-                away_rung = max(min(away.rung - game.away_step_change, 12), 1)
-            else:
-                if game.away_step != 1:
-                    away_rung = max(min(away.rung - game.away_step_change, 12), 1)
-                host_rung = max(min(host.rung - game.host_step_change, 12), 1)
-            
-            away.rung = away_rung
-            host.rung = host_rung
-        
-        game.away_step_change = None
-        game.host_step_change = None
-        game.is_complete = False
-        game.is_confirmed = False
-        game.win_claimed_ts = None
-        game.winner_id = None
-        game.save()
+        def unwin():
+            # The rung reversal, ratios and log entry are committed together
+            with db.unit_of_work():
+                if not game.unwin():
+                    return False
+                db.GameLog.write(
+                    game_id=game.id,
+                    message=f'{db.GameLog.member_string(ctx.author)} staff member used unwin command'
+                )
+            return True
         
-        host.update_ratio()
-        away.update_ratio()
+        if not await db.run(unwin):
+            return await ctx.send(f'Game {game.id} is not marked as completed.')
+        deadlines.sync(game)
         
+        host_member, away_member = ctx.guild.get_member(game.host_id), ctx.guild.get_member(game.away_id)
         self.bot.loop.create_task(settings.fix_roles(ctx.author, host_member, away_member))
-
-        db.GameLog.write(
-            game_id=game.id,
-            message=f'{db.GameLog.member_string(ctx.author)} staff member used unwin command'
-        )
+        
         return await ctx.send(
             f'Game {game.id} successfully marked as incomplete. Rung changes have been reverted.'
         )
@@ -614,11 +614,11 @@ class Matchmaking(commands.Cog):
             members = await settings.get_member(ctx, member)
         
         if not members:
-            players = [db.Player.get_by_name(member)]
+            players = [await db.run(db.Player.get_by_name, member)]
             if players[0] is None:
                 players.pop()
         else:
-            players: List[db.Player] = [db.Player.get(m.id) for m in members]
+            players: List[db.Player] = [await db.run(db.Player.get, m.id) for m in members]
         
         player: db.Player
         
@@ -656,35 +656,42 @@ class Matchmaking(commands.Cog):
         else:
             games = player.incomplete()  # default to incomplete
         
-        if games.count() == 0:
+        count = await db.run(games.count)
+        
+        if count == 0:
             return await ctx.send(
                 f'No results found. See `$help {ctx.invoked_with}` for examples.\nIncluding players: *{player.name}*'
             )
         
-        fields = []
-        for game in games.all():
-            
-            if game.is_complete and game.is_confirmed is False:
-                nm = getattr(game.winner.member(ctx.guild), "display_name", game.winner.name)
-                content_str = f'**WINNER**: (Unconfirmed) {nm}'
-            elif game.is_confirmed:
-                nm = getattr(game.winner.member(ctx.guild), "display_name", game.winner.name)
-                content_str = f'**WINNER**: {nm}'
-            elif game.is_started:
-                content_str = 'Incomplete'
-            else:
-                content_str = 'Not started'
-            
-            fields.append(
-                (
-                    f'Game {game.id}   {game.host.name} vs {game.away.name}\n*{game.name}*',
-                    f'{(game.started_ts or game.opened_ts).date().isoformat()} - {content_str}'
+        def list_games(offset, limit):
+            fields = []
+            for game in games.offset(offset).limit(limit):
+                
+                if game.is_complete and game.is_confirmed is False:
+                    nm = getattr(game.winner.member(ctx.guild), "display_name", game.winner.name)
+                    content_str = f'**WINNER**: (Unconfirmed) {nm}'
+                elif game.is_confirmed:
+                    nm = getattr(game.winner.member(ctx.guild), "display_name", game.winner.name)
+                    content_str = f'**WINNER**: {nm}'
+                elif game.is_started:
+                    content_str = 'Incomplete'
+                else:
+                    content_str = 'Not started'
+                
+                fields.append(
+                    (
+                        f'Game {game.id}   {game.host.name} vs {game.away.name}\n*{game.name}*',
+                        f'{(game.started_ts or game.opened_ts).date().isoformat()} - {content_str}'
+                    )
                 )
-            )
+            return fields
+        
+        async def fetch(offset, limit):
+            return await db.run(list_games, offset, limit)
         
         await settings.paginate(
-            ctx, fields=fields, title=f'{games.count()} {type_str} games\nIncluding players: *{player.name}*',
-            page_start=0, page_end=15, page_size=15
+            ctx, fields=settings.Paginator(fetch, page_size=15, count=count),
+            title=f'{count} {type_str} games\nIncluding players: *{player.name}*'
         )
         
     @commands.command()
@@ -699,7 +706,7 @@ class Matchmaking(commands.Cog):
         if not game:
             return await ctx.send('Game ID not provided.')
         
-        return await ctx.send(embed=game.embed(ctx.guild))
+        return await ctx.send(embed=await db.run(game.embed, ctx.guild))
     
     @commands.command()
     async def player(self, ctx: commands.Context, *, member_str: str = None):
@@ -716,11 +723,11 @@ class Matchmaking(commands.Cog):
             members = await settings.get_member(ctx, member_str)
 
         if not members:
-            players = [db.Player.get_by_name(member_str)]
+            players = [await db.run(db.Player.get_by_name, member_str)]
             if players[0] is None:
                 players.pop()
         else:
-            players: List[db.Player] = [db.Player.get(m.id) for m in members]
+            players: List[db.Player] = [await db.run(db.Player.get, m.id) for m in members]
     
         if len(players) == 1:
             p = players[0]
@@ -730,7 +737,7 @@ class Matchmaking(commands.Cog):
                     f'{m.name}{" ({})".format(m.nick) if m.nick is not None else ""} is not registered with me.'
                 )
             
-            await ctx.send(embed=p.embed(ctx.guild))
+            await ctx.send(embed=await db.run(p.embed, ctx.guild))
         elif len(players) == 0:
             await ctx.send(
                 f'Could not find any member matching **{utils.escape_mentions(member_str)}**. '
@@ -747,28 +754,30 @@ class Matchmaking(commands.Cog):
         """
         Display ladder leaderboard.
         """
-        fields = []
+        lb_data = db.Player.leaderboard()
         
-        async def process_leaderboard():
-            lb_data = db.Player.leaderboard()
+        def process_leaderboard(offset, limit):
+            fields = []
             
-            for n, player in enumerate(lb_data, start=1):
+            for row in lb_data.offset(offset).limit(limit):
                 fields.append(
                     (
-                        f'{n:>3} {player.name}',
-                        f'`Rung {player.rung}\u00A0\u00A0\u00A0\u00A0'
-                        f'W {player.wins().count()} / L {player.losses().count()}`'
+                        f'{row.rank:>3} {row.Player.name}',
+                        f'`Rung {row.Player.rung}\u00A0\u00A0\u00A0\u00A0'
+                        f'W {row.wins} / L {row.losses}`'
                     )
                 )
             
-            return fields, lb_data.count()
+            return fields
+        
+        async def fetch(offset, limit):
+            return await db.run(process_leaderboard, offset, limit)
         
         async with ctx.typing():
-            fields, count = await process_leaderboard()
+            count = await db.run(lb_data.count)
         
         await settings.paginate(
-            ctx, fields=fields, title=f'',
-            page_start=0, page_end=10, page_size=10
+            ctx, fields=settings.Paginator(fetch, page_size=10, count=count), title=f''
         )
         
     @commands.command()
@@ -789,7 +798,8 @@ class Matchmaking(commands.Cog):
         if not message:
             return await ctx.send('No message provided.')
         
-        db.GameLog.write(
+        await db.run(
+            db.GameLog.write,
             game_id=game.id,
             message=f'{db.GameLog.member_string(ctx.author)} pinged game with message:\n*{message}*'
         )
@@ -802,7 +812,7 @@ class Matchmaking(commands.Cog):
         await ctx.send(
             f'{header}\n'
             f'*{message}*\n'
-            f'{game.host.mention} {game.away.mention}'
+            f'<@{game.host_id}> <@{game.away_id}>'
         )
 
 
@@ -0,0 +1,100 @@
+# Copyright (c) 2021 Jasper Harrison. This file is licensed under the terms of the Apache license, version 2.0. #
+import asyncio
+import collections
+import typing
+
+import discord
+
+from . import settings
+from .logging import logger
+
+
+class Outbox:
+    """
+    A background queue of direct messages.
+
+    `send` queues a DM and returns straight away; a few worker tasks deliver them. Discord rate limits DMs per route
+    (opening the DM channel, then posting to it) and discord.py already waits out a 429 on the right bucket, so the
+    workers just cap how many requests are in flight at once. Failed deliveries are retried with exponential backoff,
+    and users who don't accept DMs are skipped.
+    """
+
+    def __init__(self, workers: int = 2, retries: int = 3, backoff: float = 2.0):
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics: typing.Counter[str] = collections.Counter()
+        self._queue: typing.Optional[asyncio.Queue] = None
+        self._tasks: typing.List[asyncio.Task] = []
+
+    def __len__(self):
+        return self._queue.qsize() if self._queue else 0
+
+    def _start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._tasks = [task for task in self._tasks if not task.done()]
+        for _ in range(self.workers - len(self._tasks)):
+            self._tasks.append(asyncio.get_event_loop().create_task(self._worker()))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def join(self):
+        """Wait until everything queued so far has been delivered or given up on."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    def send(self, user: typing.Union[discord.abc.User, int], content: str = None, **kwargs):
+        """Queue a DM to `user` (a user, member or id). Takes the same arguments as `Messageable.send`."""
+        self._start()
+        self._queue.put_nowait((getattr(user, 'id', user), content, kwargs))
+        self.metrics['queued'] += 1
+
+    async def _worker(self):
+        while True:
+            user_id, content, kwargs = await self._queue.get()
+            try:
+                await self._deliver(user_id, content, kwargs)
+            except Exception as e:
+                self.metrics['failed'] += 1
+                logger.exception(f'Unhandled error sending a DM to {user_id}: {e}')
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, user_id: int, content: typing.Optional[str], kwargs: dict):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.metrics['retried'] += 1
+                await asyncio.sleep(self.backoff ** attempt)
+            try:
+                user = settings.bot.get_user(user_id) or await settings.bot.fetch_user(user_id)
+                await user.send(content, **kwargs)
+            except discord.Forbidden:
+                self.metrics['forbidden'] += 1
+                logger.info(f'Not sending DM to {user_id}, they don\'t accept DMs from the bot.')
+                return
+            except discord.NotFound:
+                self.metrics['failed'] += 1
+                logger.warning(f'Not sending DM to {user_id}, the user doesn\'t exist.')
+                return
+            except discord.HTTPException as e:
+                # 429s that outlast discord.py's own retries and server errors are worth trying again, the rest aren't
+                if e.status != 429 and e.status < 500:
+                    self.metrics['failed'] += 1
+                    logger.warning(f'Failed to send DM to {user_id}: {e}')
+                    return
+                logger.debug(f'Failed to send DM to {user_id} (attempt {attempt + 1}): {e}')
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.debug(f'Failed to send DM to {user_id} (attempt {attempt + 1}): {e}')
+            else:
+                self.metrics['sent'] += 1
+                return
+
+        self.metrics['failed'] += 1
+        logger.warning(f'Gave up sending DM to {user_id} after {self.retries + 1} attempts.')
+
+
+outbox = Outbox()
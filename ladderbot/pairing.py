@@ -0,0 +1,82 @@
+# Copyright (c) 2021 Jasper Harrison. This file is licensed under the terms of the Apache license, version 2.0. #
+import operator
+import random
+import typing
+
+Entry = typing.Any
+Pair = typing.Tuple[Entry, Entry]
+
+
+class PairingEngine:
+    """
+    Turns a platform's signup pool into ``(host, away)`` pairs.
+
+    Entries are whatever `create_matchups` passes in; `player` gets the `db.Player` (or anything with `id` and `rung`)
+    out of one. Subclasses implement `pair`.
+    """
+
+    def __init__(self, seed: int = None, player: typing.Callable[[Entry], typing.Any] = operator.itemgetter(0)):
+        self.random = random.Random(seed)
+        self.player = player
+
+    def pair(self, entries: typing.List[Entry]) -> typing.List[Pair]:
+        raise NotImplementedError
+
+
+class RungDistancePairing(PairingEngine):
+    """
+    Pairs players to minimise the total rung distance between opponents, plus `rematch_penalty` for every pair that
+    `is_rematch` says played each other recently.
+
+    Without penalties, pairing neighbours in rung order is optimal. Penalties can make swapping partners within a run of
+    four neighbours better, so a linear DP over the sorted pool picks, at each step, between pairing the next two
+    entries and the best of the two crossed pairings of the next four. Players on the same rung are shuffled first, so
+    pairings differ week to week but are reproducible for a given seed.
+    """
+
+    def __init__(
+            self, seed: int = None, player: typing.Callable[[Entry], typing.Any] = operator.itemgetter(0),
+            is_rematch: typing.Callable[[int, int], bool] = None, rematch_penalty: float = 3
+    ):
+        super().__init__(seed, player)
+        self.is_rematch = is_rematch
+        self.rematch_penalty = rematch_penalty
+
+    def cost(self, a: Entry, b: Entry) -> float:
+        a, b = self.player(a), self.player(b)
+        cost = abs(a.rung - b.rung)
+        if self.is_rematch is not None and self.is_rematch(a.id, b.id):
+            cost += self.rematch_penalty
+        return cost
+
+    def pair(self, entries: typing.List[Entry]) -> typing.List[Pair]:
+        if len(entries) % 2:
+            raise ValueError(f'Cannot pair an odd number of players ({len(entries)}).')
+
+        entries = list(entries)
+        self.random.shuffle(entries)
+        entries.sort(key=lambda entry: self.player(entry).rung)
+        n = len(entries)
+
+        # best[k] is the lowest cost of pairing the first k entries, choice[k] how their last block was paired
+        best = [0.0] + [float('inf')] * n
+        choice: typing.List[typing.Optional[typing.Tuple[typing.Tuple[int, int], ...]]] = [None] * (n + 1)
+        for k in range(2, n + 1, 2):
+            best[k] = best[k - 2] + self.cost(entries[k - 2], entries[k - 1])
+            choice[k] = ((k - 2, k - 1),)
+            if k >= 4:
+                for block in (((k - 4, k - 2), (k - 3, k - 1)), ((k - 4, k - 1), (k - 3, k - 2))):
+                    cost = best[k - 4] + sum(self.cost(entries[i], entries[j]) for i, j in block)
+                    if cost < best[k]:
+                        best[k], choice[k] = cost, block
+
+        pairs = []
+        k = n
+        while k:
+            for i, j in choice[k]:
+                # Either player is as likely to host
+                pair = (entries[i], entries[j]) if self.random.random() < 0.5 else (entries[j], entries[i])
+                pairs.append(pair)
+            k -= 2 * len(choice[k])
+        pairs.reverse()
+        return pairs
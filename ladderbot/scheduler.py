@@ -0,0 +1,139 @@
+# Copyright (c) 2021 Jasper Harrison. This file is licensed under the terms of the Apache license, version 2.0. #
+import asyncio
+import datetime
+import heapq
+import typing
+
+from . import db
+
+AUTOCONFIRM = 'autoconfirm'
+SWITCH_HOST = 'switch_host'
+EXPIRE = 'expire'
+
+# How long after a win claim or the game being opened each action is due
+AUTOCONFIRM_AFTER = datetime.timedelta(hours=24)
+SWITCH_HOST_AFTER = datetime.timedelta(days=3)
+EXPIRE_AFTER = datetime.timedelta(days=6)
+# How long to wait before trying the passes for a deadline again after they failed
+RETRY_AFTER = datetime.timedelta(minutes=5)
+
+
+def deadline(game: db.Game) -> typing.Optional[typing.Tuple[datetime.datetime, str]]:
+    """Return ``(due_at, action)`` for the next thing the matchmaking loop has to do to a game, if anything."""
+    if game.is_complete and not game.is_confirmed and game.win_claimed_ts is not None:
+        return game.win_claimed_ts + AUTOCONFIRM_AFTER, AUTOCONFIRM
+    if not game.is_started and game.opened_ts is not None:
+        if game.host_switched:
+            return game.opened_ts + EXPIRE_AFTER, EXPIRE
+        return game.opened_ts + SWITCH_HOST_AFTER, SWITCH_HOST
+    return None
+
+
+class DeadlineScheduler:
+    """
+    A heap of ``(due_at, game_id, action)``, so the matchmaking loop can sleep until the next game needs something done
+    instead of polling.
+
+    Each game has at most one pending deadline. `sync` replaces it from the game's current state; entries it replaces
+    stay in the heap and are skipped when they surface. Only use it from the event loop.
+    """
+
+    def __init__(self):
+        self._heap: typing.List[typing.Tuple[datetime.datetime, int, str]] = []
+        self._pending: typing.Dict[int, typing.Tuple[datetime.datetime, str]] = {}
+        self._changed: typing.Optional[asyncio.Event] = None
+        # The entries `wait` last returned, so `retry` can put them back if their passes fail
+        self._taken: typing.List[typing.Tuple[int, str]] = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _wake(self):
+        if self._changed is not None:
+            self._changed.set()
+
+    @staticmethod
+    def pending() -> typing.List[typing.Any]:
+        """
+        Every game with a deadline, as rows of the columns `deadline` reads. Runs on the database thread; the two
+        queries match the partial indexes on the game table.
+        """
+        columns = (
+            db.Game.id, db.Game.is_complete, db.Game.is_confirmed, db.Game.win_claimed_ts, db.Game.is_started,
+            db.Game.opened_ts, db.Game.host_switched
+        )
+        unconfirmed = db.session.query(*columns).filter(
+            db.Game.is_complete.is_(True),
+            db.Game.is_confirmed.is_(False)
+        ).all()
+        unstarted = db.session.query(*columns).filter(db.Game.is_started.is_(False)).all()
+        return unconfirmed + unstarted
+
+    def load(self, games: typing.Iterable[typing.Any]):
+        """Replace every deadline with those of `games` (games or `pending` rows)."""
+        self._pending = {game.id: due for game in games if (due := deadline(game)) is not None}
+        self._heap = [(due_at, game_id, action) for game_id, (due_at, action) in self._pending.items()]
+        heapq.heapify(self._heap)
+        self._wake()
+
+    def sync(self, *games: db.Game):
+        """Reschedule games after their state changed, dropping any that no longer have anything due."""
+        for game in games:
+            due = deadline(game)
+            if due == self._pending.get(game.id):
+                continue
+            if due is None:
+                self._pending.pop(game.id, None)
+                continue
+            self._pending[game.id] = due
+            due_at, action = due
+            heapq.heappush(self._heap, (due_at, game.id, action))
+        self._wake()
+
+    def cancel(self, game_id: int):
+        self._pending.pop(game_id, None)
+
+    def _is_current(self, entry) -> bool:
+        due_at, game_id, action = entry
+        return self._pending.get(game_id) == (due_at, action)
+
+    async def wait(self) -> typing.Set[str]:
+        """Sleep until at least one deadline is due, and return the actions that are due."""
+        while True:
+            # Drop entries that were rescheduled or cancelled, so the timeout is for a real deadline
+            while self._heap and not self._is_current(self._heap[0]):
+                heapq.heappop(self._heap)
+
+            now = datetime.datetime.utcnow()
+            self._taken = []
+            # Strictly before now, so the passes' own `< cutoff` filters include everything returned here
+            while self._heap and self._heap[0][0] < now:
+                due_at, game_id, action = heapq.heappop(self._heap)
+                if self._is_current((due_at, game_id, action)):
+                    del self._pending[game_id]
+                    self._taken.append((game_id, action))
+            if self._taken:
+                return {action for _, action in self._taken}
+
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            self._changed.clear()
+            timeout = (self._heap[0][0] - now).total_seconds() if self._heap else None
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def retry(self, delay: datetime.timedelta = RETRY_AFTER):
+        """Reschedule what `wait` last returned for `delay` from now, after the passes for it failed."""
+        due_at = datetime.datetime.utcnow() + delay
+        for game_id, action in self._taken:
+            # Games synced since have a deadline from their new state already
+            if game_id not in self._pending:
+                self._pending[game_id] = (due_at, action)
+                heapq.heappush(self._heap, (due_at, game_id, action))
+        self._taken = []
+        self._wake()
+
+
+deadlines = DeadlineScheduler()
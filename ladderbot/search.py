@@ -0,0 +1,141 @@
+# Copyright (c) 2021 Jasper Harrison. This file is licensed under the terms of the Apache license, version 2.0. #
+import collections
+import heapq
+import threading
+import typing
+
+import discord
+
+Key = typing.Hashable
+
+# How many matches name lookups ask for. A query of a letter or two matches most of a large server, and callers turn
+# the matches into query parameters.
+LOOKUP_LIMIT = 25
+
+
+def trigrams(string: str) -> typing.Set[str]:
+    """Return every 3 character slice of `string`, or the string itself if it's shorter than that."""
+    if len(string) < 3:
+        return {string} if string else set()
+    return {string[i:i + 3] for i in range(len(string) - 2)}
+
+
+def similarity(a: typing.Set[str], b: typing.Set[str]) -> float:
+    """Jaccard similarity of two trigram sets, between 0 and 1."""
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+class TrigramIndex:
+    """
+    An in-memory case insensitive substring and fuzzy search over a few strings per key.
+
+    Every trigram of every string maps to the keys containing it, so a substring search only has to check the keys
+    that contain all of the query's trigrams instead of every key.
+
+    Listeners update it on the event loop while `db.Player.get_by_name` searches it on the database thread, so access
+    is serialised by a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._strings: typing.Dict[Key, typing.Tuple[str, ...]] = {}
+        self._postings: typing.DefaultDict[str, typing.Set[Key]] = collections.defaultdict(set)
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __contains__(self, key: Key):
+        return key in self._strings
+
+    def clear(self):
+        with self._lock:
+            self._strings.clear()
+            self._postings.clear()
+
+    def add(self, key: Key, *strings: typing.Optional[str]):
+        """Index `key` under `strings`, replacing whatever it was indexed under before. None is ignored."""
+        strings = tuple(s.casefold() for s in strings if s)
+        with self._lock:
+            self.remove(key)
+            self._strings[key] = strings
+            for string in strings:
+                for gram in trigrams(string):
+                    self._postings[gram].add(key)
+
+    def remove(self, key: Key):
+        with self._lock:
+            for string in self._strings.pop(key, ()):
+                for gram in trigrams(string):
+                    keys = self._postings.get(gram)
+                    if keys is None:
+                        continue
+                    keys.discard(key)
+                    if not keys:
+                        del self._postings[gram]
+
+    def _score(self, query: str, grams: typing.Set[str], key: Key) -> float:
+        scores = (
+            # Queries too short to share a trigram still rank by how much of the string they cover
+            max(similarity(grams, trigrams(string)), len(query) / len(string) if query in string else 0.0)
+            for string in self._strings[key]
+        )
+        return max(scores, default=0.0)
+
+    def search(
+            self, query: str, limit: int = None, threshold: float = 0.3, fuzzy: bool = True
+    ) -> typing.List[typing.Tuple[Key, float]]:
+        """
+        Return ``(key, score)`` for every key with a string containing `query`, best match first, at most `limit`.
+
+        If nothing contains `query` and `fuzzy` is set, keys whose strings are at least `threshold` similar to it are
+        returned instead, so typos still find something.
+        """
+        query = query.casefold()
+        if not query:
+            return []
+        grams = trigrams(query)
+
+        with self._lock:
+            if len(query) < 3:
+                # Too short to have been indexed, but the strings are short and in memory anyway
+                candidates = self._strings.keys()
+            else:
+                postings = sorted((self._postings.get(gram, set()) for gram in grams), key=len)
+                candidates = set.intersection(*postings)
+
+            matches = [
+                (key, self._score(query, grams, key)) for key in candidates
+                if any(query in string for string in self._strings[key])
+            ]
+
+            if not matches and fuzzy and len(query) >= 3:
+                sharing = {key for gram in grams for key in self._postings.get(gram, ())}
+                matches = [
+                    (key, score) for key in sharing
+                    if (score := self._score(query, grams, key)) >= threshold
+                ]
+
+        if limit is not None:
+            return heapq.nlargest(limit, matches, key=lambda match: match[1])
+        matches.sort(key=lambda match: match[1], reverse=True)
+        return matches
+
+
+class MemberIndex(TrigramIndex):
+    """Server members by id, searchable by username and nickname."""
+
+    def build(self, guild: discord.Guild):
+        with self._lock:
+            self.clear()
+            for member in guild.members:
+                self.add_member(member)
+
+    def add_member(self, member: discord.Member):
+        self.add(member.id, member.name, member.nick)
+
+
+# Built by the Admin cog once the member cache is ready, and kept up to date by its member listeners
+members = MemberIndex()
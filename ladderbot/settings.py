@@ -1,14 +1,13 @@
 # Copyright (c) 2021 Jasper Harrison. This file is licensed under the terms of the Apache license, version 2.0. #
 import asyncio
 import datetime
-import io
 import re
 import typing
 
 import discord
 from discord.ext import commands
 
-from . import db, logging
+from . import db, logging, search
 
 logger = logging.logger
 
@@ -51,94 +50,141 @@ async def discord_channel_log(*args, **kwargs):
     await channel.send(*args, **kwargs)
 
 
+class RoleRegistry:
+    """
+    The server's ladder roles, looked up by rung number or name.
+    
+    Built from a single pass over `guild.roles` and rebuilt by the Admin cog whenever a role is created, updated or
+    deleted, so role checks are dict lookups. Roles missing from the server are None.
+    """
+    
+    names = ('Mod', 'Champion', 'Placement Matches', 'Ladder Player', 'Newbie', 'Inactive')
+    
+    def __init__(self):
+        self.guild_id: typing.Optional[int] = None
+        self.rungs: typing.Dict[int, typing.Optional[discord.Role]] = {}
+        self.named: typing.Dict[str, typing.Optional[discord.Role]] = {}
+    
+    def refresh(self, guild: discord.Guild):
+        wanted = {*self.names, *(str(x) for x in range(1, 13))}
+        found = {}
+        for role in guild.roles:
+            # Keep the first match, like discord.utils.get
+            if role.name in wanted and role.name not in found:
+                found[role.name] = role
+        
+        self.rungs = {x: found.get(str(x)) for x in range(1, 13)}
+        self.named = {name: found.get(name) for name in self.names}
+        self.guild_id = guild.id
+        logger.debug(f'Role registry built for {guild}')
+    
+    def of(self, guild=None) -> 'RoleRegistry':
+        """Return the registry, building it first if it hasn't been built for `guild` yet."""
+        if not guild:
+            guild = bot.get_guild(int(conf['DEFAULT']['server_id']))
+        if guild.id != self.guild_id:
+            self.refresh(guild)
+        return self
+    
+    def rung(self, rung: int) -> typing.Optional[discord.Role]:
+        return self.rungs.get(rung)
+    
+    def __getitem__(self, name: str) -> typing.Optional[discord.Role]:
+        return self.named[name]
+
+
+role_registry = RoleRegistry()
+
+
 def get_ladder_roles(guild=None) -> typing.Tuple[
     typing.List[discord.Role], discord.Role, discord.Role, discord.Role, discord.Role
 ]:
-    if not guild:
-        guild = bot.get_guild(int(conf['DEFAULT']['server_id']))
-    
-    rung_roles = [
-        discord.utils.get(guild.roles, name=n) for n in (str(x) for x in range(1, 13))
-    ]
-    placement_matches = discord.utils.get(guild.roles, name='Placement Matches')
-    ladder_player = discord.utils.get(guild.roles, name='Ladder Player')
-    champion = discord.utils.get(guild.roles, name='Champion')
-    newbie = discord.utils.get(guild.roles, name='Newbie')
+    roles = role_registry.of(guild)
     
-    return rung_roles, placement_matches, ladder_player, champion, newbie
+    rung_roles = [roles.rung(x) for x in range(1, 13)]
+    return rung_roles, roles['Placement Matches'], roles['Ladder Player'], roles['Champion'], roles['Newbie']
 
 
 def get_rung_role(rung: int, guild=None):
-    if not guild:
-        guild = bot.get_guild(int(conf['DEFAULT']['server_id']))
-    return discord.utils.get(guild.roles, name=str(rung))
+    return role_registry.of(guild).rung(rung)
 
 
 def player_in_placement_matches(player_id: int):
-    return db.Game.query().filter(
-        db.Game.is_complete.is_(True) &
-        db.Game.is_confirmed.is_(True) &
-        db.or_(db.Game.host_id == player_id, db.Game.away_id == player_id)
-    ).count() < 4
+    stats: db.PlayerStats = db.PlayerStats.get(player_id)
+    return stats is None or stats.confirmed < 4
+
+
+# Caps how many members' roles are edited at once. discord.py waits out 429s itself, this just stops a big batch from
+# queueing every request on the same rate limit bucket at the same time.
+role_edit_semaphore = asyncio.Semaphore(4)
 
 
 async def fix_roles(*members: discord.Member):
-    for member in set(members):
-        
-        if not member or not isinstance(member, discord.Member):
-            continue
-        
-        logger.debug(f'Fixing roles for {member}')
-        
+    members = {member for member in members if member and isinstance(member, discord.Member)}
+    if not members:
+        return
+    
+    ladder_roles = get_ladder_roles(next(iter(members)).guild)
+    await asyncio.gather(*(fix_member_roles(member, ladder_roles) for member in members))
+
+
+def target_roles(member: discord.Member, ladder_roles, rung: int, in_placement_matches: bool, champion: bool):
+    """Return the full set of roles `member` should have, keeping any roles that aren't ladder roles."""
+    rung_roles, p_m, ladder_player, champ, newbie = ladder_roles
+    
+    roles = set(member.roles) - set(rung_roles) - {newbie, p_m, champ, member.guild.default_role}
+    roles.add(ladder_player)
+    roles.add(rung_roles[rung - 1])
+    if in_placement_matches:
+        roles.add(p_m)
+    if champion:
+        roles.add(champ)
+    
+    # Roles missing from the server come back from get_ladder_roles as None
+    roles.discard(None)
+    return roles
+
+
+async def fix_member_roles(member: discord.Member, ladder_roles=None):
+    """Bring a member's ladder roles in line with their player record in a single role edit."""
+    logger.debug(f'Fixing roles for {member}')
+    
+    def load():
         player: db.Player = db.Player.get(member.id)
         if player is None:
-            continue
-        
+            return None
         player.name = member.name
-        
-        rung_roles, p_m, ladder_player, champ, newbie = get_ladder_roles(member.guild)
-        # Remove newbie if the member has it
-        if newbie in member.roles:
-            await member.remove_roles(newbie)
-            
-        # Add Ladder Player if the member doesn't have it
-        if ladder_player not in member.roles:
-            await member.add_roles(ladder_player)
-
-        # Player doesn't have a rung role, give it to them
-        if not (set(rung_roles) & set(member.roles)):
-            await member.add_roles(get_rung_role(player.rung))
-        
-        # Placement matches
-        player_in_pm = player_in_placement_matches(member.id)
-        if player_in_pm:
-            if p_m not in member.roles:
-                await member.add_roles(p_m)
-        elif not player_in_pm:
-            await member.remove_roles(p_m)
-
-        # Player's rung roles are off. Fix.
-        if len(set(rung_roles) & set(member.roles)) > 1 or get_rung_role(player.rung) not in member.roles:
-            await member.add_roles(get_rung_role(player.rung))
-            await member.remove_roles(*set(rung_roles) ^ {get_rung_role(player.rung)})
-        
-        # Champion
-        if player.rung == 12 and player.leaderboard_rank()[0] == 1:
-            if champ not in member.roles:
-                await member.add_roles(champ)
-                await bot.get_channel(int(conf['channels']['announcements'])).send(
-                    f'{member.mention} has reached the top of the leaderboard and is now the reigning Champion!'
-                )
-        else:
-            await member.remove_roles(champ)
-
         player.save()
+        champion = player.rung == 12 and player.leaderboard_rank()[0] == 1
+        return player.rung, player_in_placement_matches(member.id), champion
+    
+    state = await db.run(load)
+    if state is None:
+        return
+    rung, in_pm, champion = state
+    
+    ladder_roles = ladder_roles or get_ladder_roles(member.guild)
+    champ = ladder_roles[3]
+    roles = target_roles(member, ladder_roles, rung, in_pm, champion)
+    
+    current = set(member.roles) - {member.guild.default_role}
+    if roles == current:
+        return
+    
+    async with role_edit_semaphore:
+        await member.edit(roles=list(roles))
+    
+    if champ is not None and champ in roles and champ not in current:
+        await bot.get_channel(int(conf['channels']['announcements'])).send(
+            f'{member.mention} has reached the top of the leaderboard and is now the reigning Champion!'
+        )
 
 
 def is_mod(member: discord.Member):
     if member.id == owner_id:
         return True
-    if discord.utils.get(member.guild.roles, name='Mod') in member.roles:
+    mod_role = role_registry.of(member.guild)['Mod']
+    if mod_role is not None and mod_role in member.roles:
         return True
     return False
 
@@ -151,7 +197,7 @@ def is_mod_check():
 
 def is_registered():
     async def predicate(ctx: commands.Context):
-        registered = db.Player.get(ctx.author.id) is not None
+        registered = await db.run(db.Player.get, ctx.author.id) is not None
         if not registered and not ctx.invoked_with.startswith('help'):
             await ctx.send(
                 f'{ctx.author.mention} is not registered with me. You must be registered to use this command.'
@@ -208,22 +254,22 @@ async def get_member(ctx: commands.Context, member_str: str):
     else:
         return [member]
     
-    members = ctx.guild.fetch_members()
-    possibles = set()
+    if not len(search.members):
+        search.members.build(ctx.guild)
     
-    async for poss_member in members:
-        name, nick = poss_member.name, (poss_member.nick or '')
-        
-        if member_str == nick:
+    possibles = [
+        member for member_id, _ in search.members.search(member_str, limit=search.LOOKUP_LIMIT)
+        if (member := ctx.guild.get_member(member_id)) is not None
+    ]
+    
+    for poss_member in possibles:
+        if member_str == poss_member.nick:
             return [poss_member]
-        elif (member_str in name) or (member_str in nick):
-            possibles.add(poss_member)
-        elif member_str.upper() == nick.upper():
+    for poss_member in possibles:
+        if member_str.upper() == (poss_member.nick or '').upper():
             return [poss_member]
-        elif (member_str.upper() in name.upper()) or (member_str.upper() in nick.upper()):
-            possibles.add(poss_member)
     
-    return list(possibles)
+    return possibles
 
 
 async def get_member_raw(ctx: commands.Context, m):
@@ -232,7 +278,7 @@ async def get_member_raw(ctx: commands.Context, m):
         user_id = int(match.group(1))
         return ctx.guild.get_member(user_id) or \
             discord.utils.get(ctx.message.mentions, id=user_id) or \
-            db.Player.get(user_id)
+            await db.run(db.Player.get, user_id)
     return None
 
 
@@ -254,26 +300,121 @@ def complete_since(ts, player):
     return games.count() != 0
 
 
+class Paginator:
+    """
+    Pages of ``(name, value)`` embed fields, fetched on demand and cached once fetched.
+    
+    `fetch` is a coroutine function taking ``(offset, limit)`` and returning that slice of fields, so only the pages
+    someone actually looks at are ever queried and rendered. If `count` (the total number of fields) isn't given, the
+    paginator finds the end by fetching one page ahead.
+    """
+    
+    def __init__(self, fetch, page_size: int = 10, count: int = None, sequential: bool = False):
+        self.fetch = fetch
+        self.page_size = page_size
+        self.count = count
+        # Sources that can only be read front to back (iterators) have every earlier page fetched first
+        self.sequential = sequential
+        self._pages: typing.Dict[int, list] = {}
+        self._last: typing.Optional[int] = None if count is None else max(0, (count - 1) // page_size)
+    
+    @classmethod
+    def from_list(cls, fields: list, page_size: int = 10):
+        async def fetch(offset, limit):
+            return fields[offset:offset + limit]
+        return cls(fetch, page_size, count=len(fields))
+    
+    @classmethod
+    def from_iterator(cls, iterator: typing.AsyncIterable, page_size: int = 10):
+        iterator = iterator.__aiter__()
+        
+        async def fetch(_offset, limit):
+            fields = []
+            async for field in iterator:
+                fields.append(field)
+                if len(fields) == limit:
+                    break
+            return fields
+        return cls(fetch, page_size, sequential=True)
+    
+    async def page(self, number: int) -> list:
+        if number in self._pages:
+            return self._pages[number]
+        if self._last is not None and number > self._last:
+            return []
+        if self.sequential and number > 0 and number - 1 not in self._pages:
+            await self.page(number - 1)
+            if self._last is not None and number > self._last:
+                return []
+        
+        fields = await self.fetch(number * self.page_size, self.page_size)
+        if not fields and number > 0:
+            self._last = number - 1
+            return []
+        
+        self._pages[number] = fields
+        if len(fields) < self.page_size:
+            self._last = number
+        return fields
+    
+    async def has_next(self, number: int) -> bool:
+        if self._last is None:
+            await self.page(number + 1)
+        return number < self._last if self._last is not None else True
+    
+    async def last_page(self) -> int:
+        number = 0
+        while self._last is None:
+            await self.page(number)
+            number += 1
+        return self._last
+    
+    def footer(self, number: int) -> str:
+        start = number * self.page_size
+        end = start + len(self._pages.get(number, []))
+        if self.count is not None:
+            total = str(self.count)
+        elif self._last is not None:
+            total = str(self._last * self.page_size + len(self._pages.get(self._last, [])))
+        else:
+            total = f'{sum(len(p) for p in self._pages.values())}+'
+        return f'{start + 1} - {end} of {total}'
+
+
 # noinspection DuplicatedCode
-async def paginate(ctx, title, fields, page_start=0, page_end=10, page_size=10):
+async def paginate(ctx, title, fields, page_size=10):
+    """
+    Send an embed of fields that can be paged through with reactions.
+    
+    `fields` is a `Paginator`, a list of ``(name, value)`` tuples, or an async iterator of them. Pages are only
+    fetched when they're first shown.
+    """
     # Based off code from PolyELO bot - https://github.com/Nelluk/Polytopia-ELO-bot
 
-    page_end = page_end if len(fields) > page_end else len(fields)
-
+    if isinstance(fields, Paginator):
+        paginator = fields
+    elif isinstance(fields, list):
+        paginator = Paginator.from_list(fields, page_size)
+    else:
+        paginator = Paginator.from_iterator(fields, page_size)
+    
+    page = 0
     first_loop = True
     reaction, user = None, None
     sent_message = None
 
     while True:
         embed = discord.Embed(title=title)
-        for entry in range(page_start, page_end):
-            embed.add_field(name=fields[entry][0][:256], value=fields[entry][1][:1024], inline=False)
-        if page_size < len(fields):
-            embed.set_footer(text=f'{page_start + 1} - {page_end} of {len(fields)}')
+        for name, value in await paginator.page(page):
+            embed.add_field(name=name[:256], value=value[:1024], inline=False)
+        has_previous, has_next = page > 0, await paginator.has_next(page)
+        multiple_pages = has_previous or has_next
+        if multiple_pages:
+            embed.set_footer(text=paginator.footer(page))
 
         if first_loop is True:
             sent_message = await ctx.send(embed=embed)
-            if len(fields) > page_size:
+            if multiple_pages:
                 await sent_message.add_reaction('⏪')
                 await sent_message.add_reaction('⬅')
                 await sent_message.add_reaction('➡')
@@ -293,11 +434,10 @@ async def paginate(ctx, title, fields, page_start=0, page_end=10, page_size=10):
         def check(r, u):
             e = str(r.emoji)
             compare = False
-            if page_size < len(fields):
-                if page_start > 0 and e in '⏪⬅':
-                    compare = True
-                elif page_end < len(fields) and e in '➡⏩':
-                    compare = True
+            if has_previous and e in '⏪⬅':
+                compare = True
+            elif has_next and e in '➡⏩':
+                compare = True
             return (
                     (u == ctx.message.author or (u.permissions_in(ctx.channel).manage_messages and u != ctx.guild.me))
                     and (r.message.id == sent_message.id) and compare
@@ -319,31 +459,19 @@ async def paginate(ctx, title, fields, page_start=0, page_end=10, page_size=10):
 
             if '⏪' in str(reaction.emoji):
                 # all the way to beginning
-                page_start = 0
-                page_end = page_start + page_size
+                page = 0
 
             if '⏩' in str(reaction.emoji):
                 # last page
-                page_end = len(fields)
-                page_start = page_end - page_size
+                page = await paginator.last_page()
 
             if '➡' in str(reaction.emoji):
                 # next page
-                page_start = page_start + page_size
-                page_end = page_start + page_size
+                page += 1
 
             if '⬅' in str(reaction.emoji):
                 # previous page
-                page_start = page_start - page_size
-                page_end = page_start + page_size
-
-            if page_start < 0:
-                page_start = 0
-                page_end = page_start + page_size
-
-            if page_end > len(fields):
-                page_end = len(fields)
-                page_start = page_end - page_size if (page_end - page_size) >= 0 else 0
+                page = max(page - 1, 0)
 
             first_loop = False
 
@@ -369,30 +497,45 @@ def is_in_bot_channel():
     return commands.check(predicate)
 
 
-def split_string(string):
-    
-    # Create a readable object for
-    total_length = len(string)
-    string = io.StringIO(string)
-    buffer = ''
+def _lines(fragments: typing.Iterable[str]) -> typing.Iterator[str]:
+    """Regroup text fragments into lines, each ending with its newline (apart from possibly the last)."""
+    pending = []
+    for fragment in fragments:
+        start = 0
+        while (end := fragment.find('\n', start)) != -1:
+            pending.append(fragment[start:end + 1])
+            yield ''.join(pending)
+            pending = []
+            start = end + 1
+        if start < len(fragment):
+            pending.append(fragment[start:])
+    if pending:
+        yield ''.join(pending)
+
+
+def chunk_lines(fragments: typing.Iterable[str], limit: int = 2000) -> typing.Iterator[str]:
+    """
+    Join streamed text into messages of at most `limit` characters, breaking between lines.
     
-    while chunk := string.read(1900):
-        # add the chunk onto the buffer
-        buffer += chunk
-        
-        # Get the first 1900 chars from the buffer (leaving the rest there)
-        section, buffer = buffer[:1900], buffer[1900:]
-        
-        # Get up to the last newline
-        newline = section.rfind('\n')
-        section, overflow = section[:newline], section[newline:]
+    Each message is yielded as soon as the next line won't fit in it, so it can be sent while the rest of the text is
+    still being produced. Lines longer than `limit` are split, and blank messages are skipped.
+    """
+    block, size = [], 0
+    for line in _lines(fragments):
+        while len(line) > limit:
+            if ''.join(block).strip():
+                yield ''.join(block)
+            block, size = [], 0
+            if line[:limit].strip():
+                yield line[:limit]
+            line = line[limit:]
         
-        # If the total length of the string given is less than 1.9k chars, just yield the entire string
-        if total_length < 1900:
-            yield section + overflow
-        else:
-            # otherwise put the overflow in the buffer and yield the section
-            buffer = overflow + buffer
-            
-            # yield the section that is now guaranteed to be less than 1.9k chars
-            yield section
+        if size + len(line) > limit:
+            if (message := ''.join(block)).strip():
+                yield message
+            block, size = [], 0
+        block.append(line)
+        size += len(line)
+    
+    if (message := ''.join(block)).strip():
+        yield message
@@ -0,0 +1,28 @@
+# Copyright (c) 2021 Jasper Harrison. This file is licensed under the terms of the Apache license, version 2.0. #
+import asyncio
+from configparser import ConfigParser
+
+import pytest
+
+pytest.importorskip('discord')
+pytest.importorskip('sqlalchemy')
+# `setup` creates a postgres engine, which loads the driver but doesn't connect until a query runs
+pytest.importorskip('psycopg2')
+
+from ladderbot import db  # noqa: E402
+
+
+def test_tasks_started_after_setup_get_their_own_sessions():
+    conf = ConfigParser()
+    conf.read_dict({'DEFAULT': {'psql_user': 'ladderbot', 'psql_password': 'ladderbot'}})
+    db.setup(conf)
+    assert db._scope.get() is None
+
+    async def get_session():
+        return db.session()
+
+    async def main():
+        return await asyncio.gather(asyncio.create_task(get_session()), asyncio.create_task(get_session()))
+
+    first, second = asyncio.run(main())
+    assert first is not second